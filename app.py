@@ -1,12 +1,29 @@
 import streamlit as st
 import gspread
-from google.oauth2.service_account import Credentials
+from gspread.utils import absolute_range_name, numericise_all, rowcol_to_a1
 import pandas as pd
 from datetime import datetime, timedelta
 import httpx
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import importlib.util
 import json
+import os
+from types import MappingProxyType
+import queue
+import random
+import re
+import sqlite3
+import threading
 import time
-import plotly.express as px
+import uuid
+
+SCRIPT_STARTED = time.perf_counter()  # начало текущего прогона скрипта (импорты на повторных прогонах — из sys.modules)
 
 # --- НАСТРОЙКИ ---
 SHEET_ID = "11POL8ft8ETDnI-Qhvdw0qSeP8OnPjVx55gzya1dTtEU"
@@ -15,7 +32,87 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive.file'
 ]
 APPOINTMENT_URL = "https://salon1c.ru/widget-org/812445871"
-MAX_REGENERATIONS = 3
+
+# Подбор лучшего варианта: сколько кандидатов генерируется и оценивается параллельно
+PIPELINE_DEFAULT_CANDIDATES = 3
+PIPELINE_MAX_CANDIDATES = 5
+
+# Постраничный вывод контент-плана и архива
+PAGE_SIZE_OPTIONS = [10, 20, 50, 100]
+DEFAULT_PAGE_SIZE = 20
+
+# Локальная реплика таблицы
+CACHE_DIR = ".cache"
+REPLICA_PATH = os.path.join(CACHE_DIR, "sheets_replica.sqlite3")
+REPLICA_SHEETS = ["Services", "Discounts", "General_Info", "Prompts", "Content_Plan"]
+SYNC_INTERVAL = 5  # секунд между проверками маркеров изменений
+UNMARKED_SYNC_INTERVAL = 30  # секунд между полными выгрузками, если листа-маркера нет
+FULL_SYNC_INTERVAL = 600  # секунд между принудительными полными сверками
+FRESHNESS_MAX_AGE = 5  # секунд: более старую проверку маркеров страница просит повторить
+SYNC_META_SHEET = "_Sync_Meta"  # служебный лист с маркерами изменений
+ID_PREFIXES = {"Content_Plan": "POST_"}  # листы с автоинкрементными ID в столбце A
+REVISION_COLUMN = "Revision"  # метка ревизии строки: меняется при каждой записи из приложения
+DELTA_SYNC_COLUMNS = {"Content_Plan": ["ID", "Status", REVISION_COLUMN]}  # узкие столбцы для поиска изменённых строк
+DELTA_MAX_SHARE = 0.5  # если изменилось больше этой доли строк, лист выгружается целиком
+WRITE_COALESCE_WINDOW = 0.05  # секунд копим изменения строк, прежде чем отправить их одним batch_update
+
+# DeepSeek
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+DEEPSEEK_MODEL = "deepseek-chat"
+LLM_TIMEOUT = 60
+LLM_MAX_CONNECTIONS = 20
+LLM_MAX_KEEPALIVE_CONNECTIONS = 10
+LLM_KEEPALIVE_EXPIRY = 120  # секунд держим простаивающее соединение открытым
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+GENERATION_FIELDS = ["vk_post", "tg_post", "image_prompt"]
+# Ожидаемая форма JSON-ответов: поле → (тип, значение по умолчанию; None — поле обязательно)
+GENERATION_SCHEMA = {"vk_post": (str, None), "tg_post": (str, None), "image_prompt": (str, "")}
+ANALYSIS_SCHEMA = {"scores": (dict, None), "overall_score": (float, None), "suggestions": (list, []), "summary": (str, "")}
+JSON_MAX_ATTEMPTS = 2  # запросов, если ответ не удалось ни разобрать, ни починить
+STREAM_REFRESH_INTERVAL = 0.1  # секунд между обновлениями предпросмотра при потоковой генерации
+
+# Устойчивость вызовов DeepSeek
+LLM_MAX_ATTEMPTS = 4  # попыток на запрос при 429, 5xx и сетевых ошибках
+LLM_RETRY_STATUSES = {429, 500, 502, 503, 504}
+LLM_BACKOFF_BASE = 1.0  # секунд: верхняя граница паузы удваивается с каждой попыткой (full jitter)
+LLM_BACKOFF_MAX = 30.0
+LLM_RATE_PER_SECOND = 2.0  # средняя частота запросов с клиента (под лимиты нашего тарифа)
+LLM_RATE_BURST = 8  # столько запросов можно отправить разом после простоя
+CIRCUIT_FAILURE_THRESHOLD = 5  # подряд неудачных запросов, после которых цепь размыкается
+CIRCUIT_RESET_TIMEOUT = 30  # секунд до пробного запроса после размыкания
+
+# Кэш ответов DeepSeek
+LLM_CACHE_PATH = os.path.join(CACHE_DIR, "llm_cache.sqlite3")
+LLM_CACHE_TTL = 7 * 24 * 3600  # секунд
+LLM_CACHE_MAX_ENTRIES = 2000
+
+# Журнал вызовов DeepSeek (токены, задержки, стоимость)
+LLM_METRICS_PATH = os.path.join(CACHE_DIR, "llm_metrics.sqlite3")
+LLM_METRICS_RETENTION = 90 * 24 * 3600  # секунд
+LLM_METRICS_DASHBOARD_DAYS = 30
+# Тариф deepseek-chat, USD за 1M токенов: вход из кэша DeepSeek, вход без кэша, выход
+DEEPSEEK_PRICE_PER_M_TOKENS = {"cache_hit": 0.028, "cache_miss": 0.28, "output": 0.42}
+
+# Пакетная генерация
+BATCH_CONCURRENCY = 4  # одновременных запросов к DeepSeek
+
+# Фоновые задачи (генерация, анализ, улучшение)
+JOB_WORKERS = 8  # потоков в пуле задач процесса
+JOB_POLL_INTERVAL = 0.5  # секунд между обновлениями статуса задачи на странице
+JOB_TTL = 3600  # секунд храним результат завершённой задачи
+
+# Встроенный публикатор (включается секретом PUBLISHER_ENABLED)
+VK_API_BASE = "https://api.vk.com"
+VK_API_VERSION = "5.131"
+TELEGRAM_API_BASE = "https://api.telegram.org"
+PUBLISH_TIMEOUT = 30  # секунд на запрос к VK/Telegram
+PUBLISHER_IDLE_INTERVAL = SYNC_INTERVAL  # секунд между проверками реплики на новые посты, если ближе ничего не запланировано
+PUBLISHER_RETRY_DELAY = 60  # секунд до повторной попытки после ошибки публикации
+PUBLISHER_MAX_ATTEMPTS = 3  # после стольких неудач пост ждёт перезапуска приложения
+
+# Страница состояния
+HEALTH_QUERY_PAGE = "healthz"  # ?page=healthz открывает страницу состояния без меню
+RUN_HISTORY_SIZE = 200  # сколько последних прогонов скрипта хранить для статистики
 
 # --- ИНИЦИАЛИЗАЦИЯ ---
 st.set_page_config(layout="wide", page_title="🤖 AI-Контент Студия", page_icon="🤖")
@@ -26,6 +123,8 @@ st.set_page_config(layout="wide", page_title="🤖 AI-Контент Студи
 @st.cache_resource
 def get_credentials():
     """Получение credentials для Google API"""
+    from google.oauth2.service_account import Credentials
+
     try:
         creds = Credentials.from_service_account_file('credentials.json', scopes=SCOPES)
         return creds
@@ -44,42 +143,977 @@ def get_gspread_client():
     return gspread.authorize(creds)
 
 
-@st.cache_data(ttl=300)
-def load_data_from_sheets(_client):
-    """Загрузка данных из Google Sheets"""
-    try:
-        spreadsheet = _client.open_by_key(SHEET_ID)
+# --- ЛОКАЛЬНАЯ РЕПЛИКА GOOGLE SHEETS ---
+
+class RowConflictError(Exception):
+    """Строку удалили или изменили параллельно — запись отменена, чтобы не задеть чужую строку"""
+
+
+class WriteCoalescer:
+    """Накопитель изменений строк: всё, что пришло за WRITE_COALESCE_WINDOW, уходит одним batch_update.
+
+    Очередь хранит только (лист, ID): при отправке каждая строка берётся из реплики целиком,
+    в её текущем состоянии, поэтому несколько правок одной строки дают одну запись,
+    а порядок изменений сохраняется сам собой. Соседние строки склеиваются в один диапазон.
+    Если пакетный запрос отклонён из-за данных (400), строки пишутся по одной — ошибка достаётся
+    только своей строке; 429, исчерпанная квота и сбой сети достаются всем строкам пакета сразу.
+    """
+
+    def __init__(self, replica, window):
+        self.replica = replica
+        self.window = window
+        self.stats = {'rows': 0, 'requests': 0, 'fallbacks': 0}
+        self._pending = {}  # (лист, ID) → Future ожидающих записи
+        self._flushing = False
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._thread = None
+
+    def submit(self, sheet, key):
+        """Поставить строку в очередь; Future завершится номером строки или исключением этой строки"""
+        with self._lock:
+            future = self._pending.get((sheet, str(key)))
+            if future is None:
+                future = self._pending[(sheet, str(key))] = concurrent.futures.Future()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="sheets-write-coalescer", daemon=True)
+                self._thread.start()
+        self._event.set()
+        return future
+
+    @property
+    def busy(self):
+        """Есть правки, ещё не дошедшие до таблицы (снимок листа, выгруженный сейчас, может их не содержать)"""
+        return bool(self._pending) or self._flushing
+
+    def _loop(self):
+        while True:
+            self._event.wait()
+            time.sleep(self.window)
+            self._event.clear()
+            self.flush()
+
+    def flush(self):
+        """Отправить накопленное сейчас (вызывается и перед удалением строк, которые сдвигают нумерацию)"""
+        with self.replica._remote_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = bool(pending)
+            if not pending:
+                return
+            try:
+                self._write(pending)
+            except Exception as e:
+                # Сбой вне записи строк (SQLite, сверка с таблицей): ждущие update_row_by_key
+                # получают ошибку, а не висят, поток продолжает работать
+                for future in pending.values():
+                    if not future.done():
+                        future.set_exception(e)
+                for sheet in {sheet for sheet, _ in pending}:
+                    try:
+                        self.replica.mark_diverged(sheet)
+                    except Exception:
+                        pass
+            finally:
+                self.replica.note_remote_write()
+                self._flushing = False
+
+    def _write(self, pending):
+        rows = {}
+        for (sheet, key), future in pending.items():
+            located = self.replica.current_row(sheet, key)
+            if located is None:
+                future.set_exception(RowConflictError(f"{key} уже удалён"))
+            else:
+                rows[(sheet, key)] = located
+
+        # Номера строк взяты из реплики: если в таблице строку успели удалить или лист
+        # пересортировали, запись по номеру задела бы чужую строку
+        for sheet, key in self.replica.remote_key_mismatches(
+                [(sheet, row_num, key) for (sheet, key), (row_num, _) in rows.items()]):
+            del rows[(sheet, key)]
+            pending[(sheet, key)].set_exception(RowConflictError(f"{key} сдвинут или удалён в таблице"))
+            self.replica.mark_diverged(sheet)
+
+        data = []
+        for sheet in dict.fromkeys(sheet for sheet, _ in rows):
+            block = []
+            for row_num, values in sorted(located for (name, _), located in rows.items() if name == sheet):
+                if block and row_num != block[-1][0] + 1:
+                    data.append(self._range(sheet, block))
+                    block = []
+                block.append((row_num, values))
+            data.append(self._range(sheet, block))
+        if not data:
+            return
+
+        self.stats['rows'] += len(rows)
+        try:
+            self.replica.spreadsheet().values_batch_update({'valueInputOption': 'RAW', 'data': data})
+            self.stats['requests'] += 1
+            for (sheet, key), (row_num, _) in rows.items():
+                pending[(sheet, key)].set_result(row_num)
+        except Exception as e:
+            if not self._is_range_error(e):
+                # 429, квота, сеть: поштучный повтор только умножил бы отклонённые запросы
+                self._fail(rows, pending, e)
+                return
+            self.stats['fallbacks'] += 1
+            remaining = list(rows.items())
+            for index, ((sheet, key), (row_num, values)) in enumerate(remaining):
+                try:
+                    self.replica.spreadsheet().values_batch_update(
+                        {'valueInputOption': 'RAW', 'data': [self._range(sheet, [(row_num, values)])]}
+                    )
+                    self.stats['requests'] += 1
+                    pending[(sheet, key)].set_result(row_num)
+                except Exception as e:
+                    if not self._is_range_error(e):
+                        self._fail(dict(remaining[index:]), pending, e)
+                        return
+                    self.replica.mark_diverged(sheet)
+                    pending[(sheet, key)].set_exception(e)
+
+    def _fail(self, rows, pending, error):
+        """Ошибка всей отправки: строки не записаны, листы перечитаются при ближайшей синхронизации"""
+        for sheet in {sheet for sheet, _ in rows}:
+            self.replica.mark_diverged(sheet)
+        for key in rows:
+            pending[key].set_exception(error)
+
+    @staticmethod
+    def _is_range_error(error):
+        """Ошибка в данных одного из диапазонов (400) — её стоит искать построчно"""
+        return isinstance(error, gspread.exceptions.APIError) and error.code == 400
+
+    @staticmethod
+    def _range(sheet, block):
+        first, last = block[0][0], block[-1][0]
+        width = max(len(values) for _, values in block)
+        return {
+            'range': absolute_range_name(sheet, f"A{first}:{rowcol_to_a1(last, width)}"),
+            'values': [values for _, values in block]
+        }
+
+
+class SheetReplica:
+    """Локальная SQLite-копия листов таблицы.
 
-        services_df = pd.DataFrame(spreadsheet.worksheet("Services").get_all_records())
+    Страницы читают данные только отсюда. Фоновый поток периодически читает маркеры
+    изменений с листа SYNC_META_SHEET и выгружает одним batch-запросом только листы,
+    чей маркер сменился; в реплике переписываются лишь изменившиеся строки.
+    Записи из приложения сначала применяются к реплике, затем уходят в Google Sheets;
+    изменения существующих строк отправляются пакетами через WriteCoalescer.
+    """
+
+    def __init__(self, client, sheet_id, path):
+        self.client = client
+        self.sheet_id = sheet_id
+        self.last_sync_at = None
+        self.last_sync_error = None
+        self.last_probe_at = None
+        self.last_pull_at = None
+
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._spreadsheet = None
+        self._worksheets = {}
+        self._write_seq = 0
+        self._remote_lock = threading.RLock()  # порядок записей в таблицу (удаление сдвигает номера строк)
+        self.coalescer = WriteCoalescer(self, WRITE_COALESCE_WINDOW)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sheet_rows (
+                sheet TEXT NOT NULL,
+                row_num INTEGER NOT NULL,
+                row_hash TEXT NOT NULL,
+                row_json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sheet_rows ON sheet_rows (sheet, row_num);
+            CREATE TABLE IF NOT EXISTS sheet_state (
+                sheet TEXT PRIMARY KEY,
+                headers_json TEXT NOT NULL,
+                sheet_exists INTEGER NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0,
+                synced_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS id_counters (
+                sheet TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        self._migrate_row_keys()
+        self._migrate_markers()
+
+    def _migrate_markers(self):
+        """Столбец marker в sheet_state — последний увиденный маркер изменений листа"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sheet_state)")}
+        if 'marker' not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE sheet_state ADD COLUMN marker TEXT")
+
+    def _migrate_row_keys(self):
+        """Столбец row_key (значение столбца A) с индексом — поиск строки по ID без перебора"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sheet_rows)")}
+        if 'row_key' in columns:
+            return
+        with self._conn:
+            self._conn.execute("ALTER TABLE sheet_rows ADD COLUMN row_key TEXT NOT NULL DEFAULT ''")
+            for rowid, row_json in self._conn.execute("SELECT rowid, row_json FROM sheet_rows").fetchall():
+                self._conn.execute(
+                    "UPDATE sheet_rows SET row_key = ? WHERE rowid = ?", (self._cell(json.loads(row_json), 1), rowid)
+                )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sheet_rows_key ON sheet_rows (sheet, row_key)")
+
+    # Чтение
+
+    def version(self, sheet):
+        """Номер версии листа — увеличивается при каждом изменении данных"""
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM sheet_state WHERE sheet = ?", (sheet,)).fetchone()
+        return row[0] if row else 0
+
+    def headers(self, sheet):
+        with self._lock:
+            row = self._conn.execute("SELECT headers_json FROM sheet_state WHERE sheet = ?", (sheet,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def records(self, sheet):
+        """Аналог worksheet.get_all_records(), но из локальной реплики"""
+        with self._lock:
+            state = self._conn.execute(
+                "SELECT headers_json, sheet_exists FROM sheet_state WHERE sheet = ?", (sheet,)
+            ).fetchone()
+            if state is None:
+                raise RuntimeError(f"Лист '{sheet}' ещё не синхронизирован")
+            if not state[1]:
+                raise gspread.WorksheetNotFound(sheet)
+
+            headers = json.loads(state[0])
+            rows = self._conn.execute(
+                "SELECT row_json FROM sheet_rows WHERE sheet = ? ORDER BY row_num", (sheet,)
+            ).fetchall()
+
+        return [dict(zip(headers, numericise_all(json.loads(row_json)))) for (row_json,) in rows]
+
+    def find_row(self, sheet, value, col=1):
+        """Номер строки в листе, где в столбце col стоит value (или None).
+
+        Для столбца A (ID, Prompt_ID, Key) поиск идёт по индексу, без перебора строк.
+        """
+        with self._lock:
+            if col == 1:
+                row = self._conn.execute(
+                    "SELECT MIN(row_num) FROM sheet_rows WHERE sheet = ? AND row_key = ?", (sheet, str(value))
+                ).fetchone()
+                return row[0]
+
+            rows = self._conn.execute(
+                "SELECT row_num, row_json FROM sheet_rows WHERE sheet = ? ORDER BY row_num", (sheet,)
+            ).fetchall()
+        for row_num, row_json in rows:
+            if self._cell(json.loads(row_json), col) == str(value):
+                return row_num
+        return None
 
+    def allocate_ids(self, sheet, count=1):
+        """Атомарная выдача следующих ID вида PREFIX_n по сохранённому счётчику.
+
+        Счётчик живёт в реплике и переживает перезапуск; синхронизация поднимает его,
+        если в таблице появились ID с большим номером (добавленные вручную или другим процессом).
+        """
+        prefix = ID_PREFIXES[sheet]
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value FROM id_counters WHERE sheet = ?", (sheet,)).fetchone()
+            last = row[0] if row else self._max_id_number(sheet)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO id_counters (sheet, value) VALUES (?, ?)", (sheet, last + count)
+            )
+        return [f"{prefix}{last + offset}" for offset in range(1, count + 1)]
+
+    def _max_id_number(self, sheet):
+        keys = self._conn.execute("SELECT row_key FROM sheet_rows WHERE sheet = ?", (sheet,)).fetchall()
+        return max((self._id_number(sheet, key) for (key,) in keys), default=0)
+
+    def _observe_id(self, sheet, key):
+        """Поднять счётчик, если в листе встретился ID с номером больше выданного"""
+        number = self._id_number(sheet, key)
+        if number:
+            self._conn.execute("""
+                UPDATE id_counters SET value = MAX(value, ?) WHERE sheet = ?
+            """, (number, sheet))
+
+    @staticmethod
+    def _id_number(sheet, key):
+        prefix = ID_PREFIXES.get(sheet)
+        if not prefix or not key.startswith(prefix):
+            return 0
         try:
-            discounts_df = pd.DataFrame(spreadsheet.worksheet("Discounts").get_all_records())
-        except gspread.WorksheetNotFound:
-            discounts_df = pd.DataFrame(columns=['Name_for_UI', 'Description_for_AI', 'Applicable_Category'])
+            return int(key[len(prefix):])
+        except ValueError:
+            return 0
+
+    # Синхронизация
+
+    def ensure_synced(self, sheets):
+        """Блокирующая выгрузка, если каких-то листов ещё нет в реплике (первый запуск)"""
+        known = {row[0] for row in self._conn.execute("SELECT sheet FROM sheet_state")}
+        if not set(sheets) <= known:
+            self.sync(sheets, force=True)
+
+    def sync(self, sheets=None, force=False):
+        """Выгрузка изменившихся листов одним batch-запросом и применение только изменившихся строк.
+
+        Сначала одним маленьким запросом читаются маркеры с листа SYNC_META_SHEET.
+        Листы с прежним маркером не выгружаются. force=True выгружает все листы.
+        """
+        sheets = list(sheets or REPLICA_SHEETS)
+        write_seq = self._write_seq
+
+        spreadsheet = self.spreadsheet()
+        markers = self._probe_markers(spreadsheet)
+        self.last_probe_at = time.time()
+
+        if not force:
+            if markers is None:
+                # Листа-маркера нет — выгружаем всё, но не чаще UNMARKED_SYNC_INTERVAL
+                if self.last_pull_at and time.time() - self.last_pull_at < UNMARKED_SYNC_INTERVAL:
+                    return
+            else:
+                sheets = [
+                    name for name in sheets
+                    if markers.get(name) != self._marker(name)
+                    and not self._try_delta(spreadsheet, name, markers.get(name), write_seq)
+                ]
+                if not sheets:
+                    self.last_sync_at = time.time()
+                    self.last_sync_error = None
+                    return
+
+        self._worksheets = {ws.title: ws for ws in spreadsheet.worksheets()}
+        existing = [name for name in sheets if name in self._worksheets]
+
+        value_ranges = []
+        if existing:
+            response = spreadsheet.values_batch_get([absolute_range_name(name) for name in existing])
+            value_ranges = response.get('valueRanges', [])
+
+        with self._lock:
+            if write_seq != self._write_seq or self.coalescer.busy:
+                # Пока шла выгрузка, приложение записало свои изменения — снимок мог устареть
+                self._wake.set()
+                return
+
+            for name, value_range in zip(existing, value_ranges):
+                self._apply_snapshot(name, value_range.get('values', []))
+            for name in sheets:
+                if name not in self._worksheets:
+                    self._mark_missing(name)
+            if markers is not None:
+                with self._conn:
+                    for name in sheets:
+                        self._set_marker(name, markers.get(name))
+
+        self.last_sync_at = self.last_pull_at = time.time()
+        self.last_sync_error = None
+
+    def _try_delta(self, spreadsheet, sheet, marker, write_seq):
+        if sheet not in DELTA_SYNC_COLUMNS:
+            return False
+        try:
+            return self._pull_delta(spreadsheet, sheet, marker, write_seq)
+        except gspread.exceptions.APIError:
+            return False
+
+    def _pull_delta(self, spreadsheet, sheet, marker, write_seq):
+        """Дельта-синхронизация листа: True, если изменения применены без полной выгрузки.
+
+        Одним запросом читаются заголовок и узкие столбцы DELTA_SYNC_COLUMNS (ID, Status, Revision),
+        затем вторым — только строки, где они разошлись с репликой, и новые строки в конце.
+        Удаление, перестановка строк или изменение без следа в узких столбцах — повод для
+        полной выгрузки (False).
+        """
+        headers = self.headers(sheet)
+        if not headers or any(column not in headers for column in DELTA_SYNC_COLUMNS[sheet]):
+            return False
+
+        indexes = [headers.index(column) for column in DELTA_SYNC_COLUMNS[sheet]]
+        letters = [rowcol_to_a1(1, index + 1)[:-1] for index in indexes]
+        response = spreadsheet.values_batch_get(
+            [absolute_range_name(sheet, "1:1")] + [absolute_range_name(sheet, f"{letter}2:{letter}") for letter in letters],
+            params={'majorDimension': 'COLUMNS'}
+        )
+        value_ranges = response.get('valueRanges', [])
+        remote_headers = [column[0] if column else '' for column in value_ranges[0].get('values', [])]
+        if remote_headers != headers:
+            return False
+
+        columns = [(value_range.get('values') or [[]])[0] for value_range in value_ranges[1:]]
+        remote_count = max(len(column) for column in columns)
+        remote = [
+            tuple(self._cell(column, row) for column in columns)
+            for row in range(1, remote_count + 1)
+        ]
+
+        with self._lock:
+            local = [
+                tuple(self._cell(json.loads(row_json), index + 1) for index in indexes)
+                for (row_json,) in self._conn.execute(
+                    "SELECT row_json FROM sheet_rows WHERE sheet = ? ORDER BY row_num", (sheet,)
+                )
+            ]
+        if remote_count < len(local):
+            return False
+
+        changed = []
+        for offset, remote_row in enumerate(remote):
+            if offset < len(local):
+                if remote_row[0] != local[offset][0]:
+                    return False
+                if remote_row == local[offset]:
+                    continue
+            changed.append(offset + 2)
+
+        if not changed:
+            # Маркер сдвинулся, а узкие столбцы совпадают: правка без следа в них (или наша запись,
+            # но в том же окне мог быть и чужой ввод) — отличить нельзя, выгружаем лист целиком
+            return False
+        if len(changed) > max(1, len(remote) * DELTA_MAX_SHARE):
+            return False
+
+        blocks = []
+        for row_num in changed:
+            if blocks and blocks[-1][1] == row_num - 1:
+                blocks[-1][1] = row_num
+            else:
+                blocks.append([row_num, row_num])
+        last_col = rowcol_to_a1(1, len(headers))[:-1]
+        response = spreadsheet.values_batch_get(
+            [absolute_range_name(sheet, f"A{first}:{last_col}{last}") for first, last in blocks]
+        )
 
+        with self._lock:
+            if write_seq != self._write_seq or self.coalescer.busy:
+                self._wake.set()
+                return True
+
+            with self._conn:
+                for (first, last), value_range in zip(blocks, response.get('valueRanges', [])):
+                    values = value_range.get('values', [])
+                    for row_num in range(first, last + 1):
+                        raw = values[row_num - first] if row_num - first < len(values) else []
+                        row = self._normalize_row(raw, len(headers))
+                        self._insert_row(sheet, row_num, row, self._row_hash(row))
+                        self._observe_id(sheet, self._cell(row, 1))
+                self._save_state(sheet, headers, True, bump=True)
+                self._set_marker(sheet, marker)
+        return True
+
+    def _probe_markers(self, spreadsheet):
+        """Маркеры изменений {лист: значение} одним запросом (None, если листа-маркера нет)"""
         try:
-            general_info = {row['Key']: row['Value']
-                            for row in spreadsheet.worksheet("General_Info").get_all_records()}
-        except gspread.WorksheetNotFound:
-            general_info = {
-                'Tone_of_Voice': 'Профессионально и дружелюбно',
-                'Blacklist_Words': '',
-                'Address': 'Москва'
-            }
+            response = spreadsheet.values_get(absolute_range_name(SYNC_META_SHEET, "A2:B"))
+        except gspread.exceptions.APIError:
+            return None
+        return {row[0]: row[1] for row in response.get('values', []) if len(row) >= 2}
+
+    def _marker(self, sheet):
+        row = self._conn.execute("SELECT marker FROM sheet_state WHERE sheet = ?", (sheet,)).fetchone()
+        return row[0] if row else None
+
+    def _set_marker(self, sheet, marker):
+        self._conn.execute("UPDATE sheet_state SET marker = ? WHERE sheet = ?", (marker, sheet))
 
-        return services_df, discounts_df, general_info
+    def refresh_if_stale(self, max_age=FRESHNESS_MAX_AGE):
+        """Не блокируя страницу, попросить фоновый поток сверить маркеры, если проверка устарела"""
+        if self.last_probe_at is None or time.time() - self.last_probe_at > max_age:
+            self.request_sync()
+
+    def request_sync(self):
+        """Разбудить фоновый поток синхронизации раньше срока"""
+        self._wake.set()
+
+    def start(self, interval):
+        """Запуск фонового потока синхронизации (один на процесс)"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._sync_loop, args=(interval,), name="sheets-replica-sync", daemon=True
+        )
+        self._thread.start()
+
+    def _sync_loop(self, interval):
+        last_full_sync = time.time()
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            # Маркер — контрольные суммы, а не хэш: изредка сверяем листы целиком
+            force = time.time() - last_full_sync >= FULL_SYNC_INTERVAL
+            try:
+                self.sync(force=force)
+                if force:
+                    last_full_sync = time.time()
+            except Exception as e:
+                self.last_sync_error = str(e)
+
+    def _apply_snapshot(self, sheet, values):
+        headers = values[0] if values else []
+        width = len(headers)
+        rows = [self._normalize_row(raw, width) for raw in values[1:]]
+
+        with self._conn:
+            current = dict(self._conn.execute(
+                "SELECT row_num, row_hash FROM sheet_rows WHERE sheet = ?", (sheet,)
+            ).fetchall())
+            changed = json.dumps(headers, ensure_ascii=False) != json.dumps(self.headers(sheet), ensure_ascii=False)
+
+            for offset, row in enumerate(rows):
+                row_num = offset + 2
+                row_hash = self._row_hash(row)
+                if current.get(row_num) == row_hash:
+                    continue
+                self._insert_row(sheet, row_num, row, row_hash)
+                self._observe_id(sheet, self._cell(row, 1))
+                changed = True
+
+            removed = self._conn.execute(
+                "DELETE FROM sheet_rows WHERE sheet = ? AND row_num > ?", (sheet, len(rows) + 1)
+            ).rowcount
+            changed = changed or removed > 0
+
+            self._save_state(sheet, headers, True, bump=changed)
+
+    def _mark_missing(self, sheet):
+        with self._conn:
+            self._conn.execute("DELETE FROM sheet_rows WHERE sheet = ?", (sheet,))
+            self._save_state(sheet, [], False, bump=True)
+
+    def _save_state(self, sheet, headers, sheet_exists, bump):
+        self._conn.execute("""
+            INSERT INTO sheet_state (sheet, headers_json, sheet_exists, version, synced_at)
+            VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT(sheet) DO UPDATE SET
+                headers_json = excluded.headers_json,
+                sheet_exists = excluded.sheet_exists,
+                version = version + ?,
+                synced_at = excluded.synced_at
+        """, (sheet, json.dumps(headers, ensure_ascii=False), int(sheet_exists), time.time(), int(bump)))
+
+    @staticmethod
+    def _normalize_row(raw, width):
+        row = ['' if value is None else str(value) for value in raw]
+        if width:
+            row = (row + [''] * width)[:width]
+        return row
+
+    @staticmethod
+    def _cell(row, col):
+        return row[col - 1] if len(row) >= col else ''
+
+    @staticmethod
+    def _row_hash(row):
+        return hashlib.sha1(json.dumps(row, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    # Запись (write-through)
+
+    def spreadsheet(self):
+        if self._spreadsheet is None:
+            self._spreadsheet = self.client.open_by_key(self.sheet_id)
+        return self._spreadsheet
+
+    def worksheet(self, sheet):
+        if sheet not in self._worksheets:
+            self._worksheets[sheet] = self.spreadsheet().worksheet(sheet)
+        return self._worksheets[sheet]
+
+    def stamp_revision(self, sheet, rows):
+        """Проставить в строках новую метку ревизии, если у листа есть столбец REVISION_COLUMN"""
+        headers = self.headers(sheet)
+        if sheet not in DELTA_SYNC_COLUMNS or REVISION_COLUMN not in headers:
+            return rows
+
+        index = headers.index(REVISION_COLUMN)
+        # Нечисловая метка: при USER_ENTERED число из 19 цифр Sheets сохранит как float с потерей
+        # точности, и при дельта-синхронизации строка каждый раз выглядела бы изменённой
+        revision = f"r{time.time_ns():x}"
+        stamped = []
+        for row in rows:
+            row = list(row) + [''] * max(0, index + 1 - len(row))
+            row[index] = revision
+            stamped.append(row)
+        return stamped
+
+    def append_rows(self, sheet, rows, value_input_option='USER_ENTERED'):
+        """Добавление строк в конец листа"""
+        rows = self.stamp_revision(sheet, rows)
+
+        def local():
+            last = self._conn.execute(
+                "SELECT COALESCE(MAX(row_num), 1) FROM sheet_rows WHERE sheet = ?", (sheet,)
+            ).fetchone()[0]
+            for offset, row in enumerate(rows, start=1):
+                self._put_row(sheet, last + offset, row)
+
+        return self._write_through(
+            sheet, local,
+            lambda ws, _: ws.append_rows(rows, value_input_option=value_input_option)
+        )
+
+    def update_cells(self, sheet, row_num, first_col, values, value_input_option='RAW'):
+        """Перезапись ячеек строки row_num, начиная со столбца first_col"""
+        def local():
+            current = self._conn.execute(
+                "SELECT row_json FROM sheet_rows WHERE sheet = ? AND row_num = ?", (sheet, row_num)
+            ).fetchone()
+            row = json.loads(current[0]) if current else [''] * len(self.headers(sheet))
+            key = self._cell(row, 1)
+            end = first_col - 1 + len(values)
+            row = row + [''] * max(0, end - len(row))
+            row[first_col - 1:end] = [str(value) for value in values]
+            self._put_row(sheet, row_num, row)
+            return key
+
+        def remote(ws, key):
+            self.ensure_remote_rows(sheet, {row_num: key})
+            return ws.update(range_name=cell_range, values=[values], value_input_option=value_input_option)
+
+        cell_range = f"{rowcol_to_a1(row_num, first_col)}:{rowcol_to_a1(row_num, first_col + len(values) - 1)}"
+        return self._write_through(sheet, local, remote)
+
+    def row_version(self, sheet, key):
+        """Отпечаток текущего содержимого строки с ID key (None, если строки нет)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT row_hash FROM sheet_rows WHERE sheet = ? AND row_key = ? ORDER BY row_num", (sheet, str(key))
+            ).fetchone()
+        return row[0] if row else None
+
+    def update_row_by_key(self, sheet, key, values, expected_version=None):
+        """Перезапись строки с ID key (значения пишутся как есть, RAW).
+
+        Номер строки берётся из индекса в момент записи. Если строку успели удалить или
+        изменить после того, как оператор открыл её (expected_version), — RowConflictError.
+        Запись уходит в таблицу вместе с другими через WriteCoalescer; метод ждёт её результата.
+        """
+        return self.update_rows_by_key(sheet, {key: values}, {key: expected_version})[key].result()
+
+    def update_rows_by_key(self, sheet, rows, expected_versions=None):
+        """Перезапись нескольких строк {ID: значения} одним запросом; возвращает {ID: Future}.
+
+        Строка с конфликтом версии получает RowConflictError в своём Future, остальные пишутся.
+        """
+        expected_versions = expected_versions or {}
+        futures = {}
+        with self._lock, self._conn:
+            self._write_seq += 1
+            for key, values in rows.items():
+                try:
+                    row_num = self._locate(sheet, key, expected_versions.get(key))
+                except RowConflictError as e:
+                    futures[key] = concurrent.futures.Future()
+                    futures[key].set_exception(e)
+                    continue
+                self._put_row(sheet, row_num, self.stamp_revision(sheet, [values])[0])
+            self._conn.execute("UPDATE sheet_state SET version = version + 1 WHERE sheet = ?", (sheet,))
+        for key in rows:
+            if key not in futures:
+                futures[key] = self.coalescer.submit(sheet, key)
+        return futures
+
+    def update_fields_by_key(self, sheet, updates, expected_versions=None):
+        """Изменение отдельных полей {ID: {столбец: значение}} нескольких строк одним запросом.
+
+        expected_versions — {ID: версия} на момент выбора строк (как в update_rows_by_key):
+        строка, изменённая после этого, не перезаписывается.
+        Возвращает {ID: ошибка} для строк, которые записать не удалось (пустой словарь — всё записано).
+        """
+        headers = self.headers(sheet)
+        rows = {}
+        with self._lock:
+            for key, fields in updates.items():
+                located = self.current_row(sheet, key)
+                if located is None:
+                    continue
+                values = located[1]
+                for column, value in fields.items():
+                    values[headers.index(column)] = str(value)
+                rows[key] = values
+            # Версия сверяется в _locate по строке до записи, под той же блокировкой
+            futures = self.update_rows_by_key(sheet, rows, expected_versions)
+
+        errors = {key: RowConflictError(f"{key} уже удалён") for key in updates if key not in rows}
+        for key, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors[key] = e
+        return errors
+
+    def current_row(self, sheet, key):
+        """(номер строки, значения по ширине заголовка) строки с ID key из реплики или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT row_num, row_json FROM sheet_rows WHERE sheet = ? AND row_key = ? ORDER BY row_num",
+                (sheet, str(key))
+            ).fetchone()
+            if row is None:
+                return None
+            return row[0], self._normalize_row(json.loads(row[1]), len(self.headers(sheet)))
+
+    def mark_diverged(self, sheet):
+        """Реплика разошлась с таблицей — сбрасываем маркер, чтобы лист перечитался при ближайшей синхронизации"""
+        with self._lock, self._conn:
+            self._set_marker(sheet, '')
+        self.request_sync()
+
+    def delete_row_by_key(self, sheet, key, expected_version=None):
+        """Удаление строки с ID key с той же проверкой версии, что и в update_row_by_key"""
+        def local():
+            row_num = self._locate(sheet, key, expected_version)
+            self._remove_row(sheet, row_num)
+            return row_num
+
+        def remote(ws, row_num):
+            self.ensure_remote_rows(sheet, {row_num: key})
+            return ws.delete_rows(row_num)
+
+        return self._write_through(sheet, local, remote)
+
+    def delete_rows_by_key(self, sheet, keys, expected_versions=None):
+        """Удаление нескольких строк одним spreadsheet.batch_update с запросами deleteDimension.
+
+        Запросы идут снизу вверх, соседние строки удаляются одним диапазоном, поэтому
+        номера ещё не удалённых строк не сдвигаются. Строки с конфликтом версии (как в
+        update_row_by_key) не трогаются — возвращается {ID: ошибка} для них. Если хоть одна
+        строка в таблице уже не на месте, известном реплике, не удаляется ничего (RowConflictError).
+        """
+        expected_versions = expected_versions or {}
+        errors = {}
+
+        def local():
+            located = {}
+            for key in keys:
+                try:
+                    located[self._locate(sheet, key, expected_versions.get(key))] = key
+                except RowConflictError as e:
+                    errors[key] = e
+            for row_num in sorted(located, reverse=True):
+                self._remove_row(sheet, row_num)
+            return located
+
+        def remote(ws, located):
+            # Один запрос удаляет сразу несколько диапазонов: сдвиг в таблице задел бы чужие строки
+            self.ensure_remote_rows(sheet, located)
+            row_nums = sorted(located, reverse=True)
+            blocks = []
+            for row_num in row_nums:
+                if blocks and row_num == blocks[-1][0] - 1:
+                    blocks[-1][0] = row_num
+                else:
+                    blocks.append([row_num, row_num])
+            if blocks:
+                self.spreadsheet().batch_update({'requests': [
+                    {'deleteDimension': {'range': {
+                        'sheetId': ws.id, 'dimension': 'ROWS', 'startIndex': first - 1, 'endIndex': last
+                    }}}
+                    for first, last in blocks
+                ]})
+            return errors
+
+        return self._write_through(sheet, local, remote)
+
+    def remote_key_mismatches(self, targets):
+        """Строки (лист, ID), которых в таблице уже нет на месте, известном реплике.
+
+        targets — список (лист, номер строки, ID). Одним values_batch_get читается столбец A
+        этих строк (соседние — одним диапазоном): реплика может отставать от таблицы
+        на интервал синхронизации, а запись идёт по номеру строки.
+        """
+        if not targets:
+            return set()
+        blocks = []
+        for sheet, row_num, _ in sorted(targets, key=lambda target: (target[0], target[1])):
+            if blocks and blocks[-1][0] == sheet and blocks[-1][2] >= row_num - 1:
+                blocks[-1][2] = row_num
+            else:
+                blocks.append([sheet, row_num, row_num])
+        response = self.spreadsheet().values_batch_get(
+            [absolute_range_name(sheet, f"A{first}:A{last}") for sheet, first, last in blocks]
+        )
+
+        remote = {}
+        for (sheet, first, last), value_range in zip(blocks, response.get('valueRanges', [])):
+            values = value_range.get('values', [])
+            for row_num in range(first, last + 1):
+                remote[(sheet, row_num)] = self._cell(values[row_num - first] if row_num - first < len(values) else [], 1)
+        return {(sheet, str(key)) for sheet, row_num, key in targets if remote.get((sheet, row_num)) != str(key)}
+
+    def ensure_remote_rows(self, sheet, rows):
+        """Проверка {номер строки: ID} по таблице перед записью; расхождение — RowConflictError"""
+        mismatched = sorted(key for _, key in self.remote_key_mismatches(
+            [(sheet, row_num, key) for row_num, key in rows.items()]
+        ))
+        if mismatched:
+            raise RowConflictError(f"{', '.join(mismatched)} сдвинут или удалён в таблице, обновите страницу")
+
+    def _locate(self, sheet, key, expected_version):
+        row = self._conn.execute(
+            "SELECT row_num, row_hash FROM sheet_rows WHERE sheet = ? AND row_key = ? ORDER BY row_num", (sheet, str(key))
+        ).fetchone()
+        if row is None:
+            raise RowConflictError(f"{key} уже удалён")
+        if expected_version is not None and row[1] != expected_version:
+            raise RowConflictError(f"{key} был изменён после открытия")
+        return row[0]
+
+    def _remove_row(self, sheet, row_num):
+        """Удаление строки со сдвигом нижележащих строк, как в Google Sheets"""
+        self._conn.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row_num = ?", (sheet, row_num))
+        self._conn.execute(
+            "UPDATE sheet_rows SET row_num = row_num - 1 WHERE sheet = ? AND row_num > ?", (sheet, row_num)
+        )
+
+    def _put_row(self, sheet, row_num, row):
+        row = self._normalize_row(row, len(self.headers(sheet)))
+        self._insert_row(sheet, row_num, row, self._row_hash(row))
+
+    def _insert_row(self, sheet, row_num, row, row_hash):
+        self._conn.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row_num = ?", (sheet, row_num))
+        self._conn.execute(
+            "INSERT INTO sheet_rows (sheet, row_num, row_key, row_hash, row_json) VALUES (?, ?, ?, ?, ?)",
+            (sheet, row_num, self._cell(row, 1), row_hash, json.dumps(row, ensure_ascii=False))
+        )
+
+    def _write_through(self, sheet, local_change, remote_change):
+        # Сначала отправляем накопленные правки строк: их номера посчитаны до этой записи
+        self.coalescer.flush()
+        with self._remote_lock:
+            with self._lock, self._conn:
+                self._write_seq += 1
+                local_result = local_change()
+                self._conn.execute("UPDATE sheet_state SET version = version + 1 WHERE sheet = ?", (sheet,))
+
+            try:
+                return remote_change(self.worksheet(sheet), local_result)
+            except Exception:
+                self.mark_diverged(sheet)
+                raise
+            finally:
+                self.note_remote_write()
+
+    def note_remote_write(self):
+        """Запись дошла (или не дошла) до таблицы: синхронизация, выгрузившая лист во время неё,
+        отбросит свой снимок — он мог быть снят до записи и откатил бы локальную правку"""
+        with self._lock:
+            self._write_seq += 1
+
+
+@st.cache_resource
+def get_replica(_client):
+    """Реплика таблицы: один экземпляр и один поток синхронизации на процесс"""
+    replica = SheetReplica(_client, SHEET_ID, REPLICA_PATH)
+    try:
+        replica.ensure_synced(REPLICA_SHEETS)
+    except Exception as e:
+        replica.last_sync_error = str(e)
+    replica.start(SYNC_INTERVAL)
+    return replica
+
+
+# Настройки салона по умолчанию (если листа General_Info или ключа в нём нет)
+GENERAL_INFO_DEFAULTS = {
+    'Tone_of_Voice': 'Профессионально и дружелюбно',
+    'Blacklist_Words': '',
+    'Address': 'Москва'
+}
+
+
+# Каждый справочник кэшируется по версии своего листа: правка настроек не пересобирает услуги и акции
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_services_frame(_replica, version):
+    """Услуги из реплики (лист Services) для указанной версии листа"""
+    return pd.DataFrame(_replica.records("Services"))
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_discounts_frame(_replica, version):
+    """Акции из реплики (лист Discounts); пустая таблица, если листа нет"""
+    try:
+        return pd.DataFrame(_replica.records("Discounts"))
+    except gspread.WorksheetNotFound:
+        return pd.DataFrame(columns=['Name_for_UI', 'Description_for_AI', 'Applicable_Category'])
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_general_info(_replica, version):
+    """Настройки салона из реплики (лист General_Info) как словарь; значения по умолчанию, если листа нет"""
+    try:
+        return {row['Key']: row['Value'] for row in _replica.records("General_Info")}
+    except gspread.WorksheetNotFound:
+        return dict(GENERAL_INFO_DEFAULTS)
+
+
+def load_data_from_sheets(_client):
+    """Загрузка справочников из локальной реплики Google Sheets"""
+    try:
+        replica = get_replica(_client)
+        return (
+            build_services_frame(replica, replica.version("Services")),
+            build_discounts_frame(replica, replica.version("Discounts")),
+            build_general_info(replica, replica.version("General_Info"))
+        )
     except Exception as e:
         st.error(f"❌ Ошибка при загрузке данных: {e}")
         st.stop()
 
 
-@st.cache_data(ttl=300)
+class SettingsStore:
+    """Настройки салона (лист General_Info) как словарь ключ → значение.
+
+    Читает из того же кэша, что и load_data_from_sheets. save() сравнивает форму
+    с текущими значениями и пишет только изменённые ключи: существующие — одним
+    batch_update через WriteCoalescer, новые — одним append_rows.
+    """
+
+    SHEET = "General_Info"
+
+    def __init__(self, replica):
+        self.replica = replica
+
+    def values(self):
+        return build_general_info(self.replica, self.replica.version(self.SHEET))
+
+    def get(self, key):
+        return self.values().get(key, GENERAL_INFO_DEFAULTS.get(key, ''))
+
+    def diff(self, new_values):
+        """Ключи, значение которых в форме отличается от сохранённого (или которых ещё нет в листе)"""
+        current = self.values()
+        return {key: value for key, value in new_values.items() if key not in current or str(current[key]) != str(value)}
+
+    def save(self, new_values):
+        """Запись изменённых ключей; возвращает словарь записанных изменений"""
+        changes = self.diff(new_values)
+        existing = {key: {'Value': value} for key, value in changes.items()
+                    if self.replica.current_row(self.SHEET, key) is not None}
+        if existing:
+            errors = self.replica.update_fields_by_key(self.SHEET, existing)
+            if errors:
+                raise RuntimeError("; ".join(f"{key}: {error}" for key, error in errors.items()))
+        added = [[key, value] for key, value in changes.items() if key not in existing]
+        if added:
+            self.replica.append_rows(self.SHEET, added, value_input_option='RAW')
+        return changes
+
+
 def load_prompts(_client):
-    """Загрузка промптов из Google Sheets"""
+    """Загрузка промптов из локальной реплики Google Sheets"""
     try:
-        spreadsheet = _client.open_by_key(SHEET_ID)
-        worksheet = spreadsheet.worksheet("Prompts")
-        data = worksheet.get_all_records()
+        data = get_replica(_client).records("Prompts")
 
         if not data:
             return pd.DataFrame(columns=['Prompt_ID', 'Prompt_Name', 'Prompt_Text', 'Active'])
@@ -94,115 +1128,1345 @@ def load_prompts(_client):
         return pd.DataFrame(columns=['Prompt_ID', 'Prompt_Name', 'Prompt_Text', 'Active'])
 
 
-@st.cache_data(ttl=60)
-def load_content_plan(_client):
-    """Загрузка контент-плана"""
-    try:
-        spreadsheet = _client.open_by_key(SHEET_ID)
-        worksheet = spreadsheet.worksheet("Content_Plan")
-        data = worksheet.get_all_records()
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_content_plan_frame(_replica, version):
+    """Типизированный контент-план: считается один раз на версию листа в реплике.
 
-        if not data:
-            return pd.DataFrame(
-                columns=['ID', 'Publish_Time', 'Status', 'Post_Type', 'VK_Text', 'TG_Text', 'Image_Prompt',
-                         'Created_At'])
+    Publish_DateTime разобран из Publish_Time, Status и Post_Type — категории,
+    индекс — отсортированные даты публикации (строки без даты в конце).
+    """
+    data = _replica.records("Content_Plan")
+    df = pd.DataFrame(data, columns=None if data else SHEET_SCHEMA["Content_Plan"])
 
-        df = pd.DataFrame(data)
-        return df
+    df['Publish_DateTime'] = pd.to_datetime(df['Publish_Time'].astype(str), format='mixed', errors='coerce')
+    for column in ['Status', 'Post_Type']:
+        df[column] = df[column].astype(str).astype('category')
+
+    df = df.sort_values('Publish_DateTime', kind='stable', na_position='last')
+    df.index = pd.DatetimeIndex(df['Publish_DateTime'], name=None)
+    return df
+
+
+def load_content_plan(_client):
+    """Загрузка контент-плана из локальной реплики Google Sheets"""
+    try:
+        replica = get_replica(_client)
+        return build_content_plan_frame(replica, replica.version("Content_Plan"))
     except Exception as e:
         st.error(f"❌ Ошибка загрузки контент-плана: {e}")
         return pd.DataFrame()
 
 
-def ensure_content_plan_sheet(client):
-    """Проверка наличия листа Content_Plan"""
+def slice_by_publish_time(df, start=None, end=None):
+    """Посты с датой публикации в [start, end) — срез по отсортированному индексу без перебора строк"""
+    dated = df.index[:int(df.index.notna().sum())]
+    first = dated.searchsorted(pd.Timestamp(start)) if start is not None else 0
+    last = dated.searchsorted(pd.Timestamp(end)) if end is not None else len(dated)
+    return df.iloc[first:last]
+
+
+def order_by_publish_time(df, ascending=True):
+    """Кадр уже отсортирован по дате: для обратного порядка переворачиваем датированную часть, без даты — в конце"""
+    if ascending:
+        return df
+    dated = df.index.notna()
+    return pd.concat([df[dated].iloc[::-1], df[~dated]])
+
+
+# --- ТРАНСПОРТ DEEPSEEK ---
+
+class CircuitOpenError(Exception):
+    """DeepSeek недоступен: после серии ошибок запросы временно не отправляются"""
+
+
+class TokenBucket:
+    """Клиентский ограничитель частоты запросов: rate запросов в секунду, до burst подряд.
+
+    Живёт в event loop транспорта. pause() останавливает выдачу для всех запросов
+    процесса — так ответ 429 с Retry-After притормаживает всех, а не одного.
+    asyncio.Lock создаётся при первом acquire(), уже в потоке транспорта: на Python 3.9
+    конструктор требует текущий event loop, а у потока скрипта Streamlit его нет.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @property
+    def tokens(self):
+        return min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate)
+
+
+class CircuitBreaker:
+    """Размыкатель цепи на процесс: после threshold неудач подряд запросы отклоняются сразу,
+    через reset_timeout пропускается один пробный запрос."""
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def before_call(self):
+        state = self.state
+        if state == 'open':
+            wait = self.reset_timeout - (time.monotonic() - self._opened_at)
+            raise CircuitOpenError(f"DeepSeek временно недоступен после серии ошибок, повтор через {wait:.0f} с")
+        if state == 'half_open':
+            if self._trial_in_flight:
+                raise CircuitOpenError("DeepSeek временно недоступен, идёт пробный запрос")
+            self._trial_in_flight = True
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+
+    def release_trial(self):
+        """Освободить пробный запрос, если попытка завершилась без вердикта (например, отменена)"""
+        self._trial_in_flight = False
+
+
+def parse_retry_after(response):
+    """Пауза из заголовка Retry-After (секунды, не больше LLM_BACKOFF_MAX) или None.
+
+    Пауза останавливает общий TokenBucket, то есть все сессии и пакетные задачи процесса,
+    поэтому слишком большое значение сервера ограничивается.
+    """
     try:
-        spreadsheet = client.open_by_key(SHEET_ID)
+        return min(LLM_BACKOFF_MAX, max(0.0, float(response.headers['Retry-After'])))
+    except (KeyError, ValueError):
+        return None
+
+
+class LLMTransport:
+    """Общий для всего процесса асинхронный клиент DeepSeek.
+
+    httpx.AsyncClient с пулом соединений и HTTP/2 работает в отдельном потоке со своим
+    event loop, поэтому TLS-соединения переиспользуются всеми сессиями Streamlit.
+    Код страниц вызывает chat(), асинхронный код — achat() или submit().
+
+    Каждая попытка проходит через TokenBucket и CircuitBreaker; 429, 5xx и сетевые
+    ошибки повторяются с экспоненциальной паузой со случайным разбросом или по Retry-After.
+    """
+
+    def __init__(self, api_key):
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'rejected': 0}
+        self.bucket = TokenBucket(LLM_RATE_PER_SECOND, LLM_RATE_BURST)
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-transport", daemon=True)
+        self._thread.start()
+        self._client = self.run(self._create_client(api_key))
+        atexit.register(self.close)
+
+    @staticmethod
+    async def _create_client(api_key):
+        return httpx.AsyncClient(
+            base_url=DEEPSEEK_BASE_URL,
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=10),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            ),
+            http2=HTTP2_AVAILABLE
+        )
+
+    def run(self, coro, timeout=None):
+        """Выполнить корутину в потоке транспорта и дождаться результата"""
+        return self.submit(coro).result(timeout)
+
+    def submit(self, coro):
+        """Запустить корутину в потоке транспорта, вернуть concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _before_attempt(self):
         try:
-            worksheet = spreadsheet.worksheet("Content_Plan")
-            headers = worksheet.row_values(1)
-            if not headers or len(headers) < 8:
-                st.warning(
-                    "⚠️ Проверьте структуру листа Content_Plan. Должны быть столбцы: ID, Publish_Time, Status, Post_Type, VK_Text, TG_Text, Image_Prompt, Created_At")
-        except gspread.WorksheetNotFound:
-            st.info("📋 Создаю лист Content_Plan...")
-            worksheet = spreadsheet.add_worksheet(title="Content_Plan", rows="100", cols="8")
-            worksheet.append_row([
-                "ID", "Publish_Time", "Status", "Post_Type",
-                "VK_Text", "TG_Text", "Image_Prompt", "Created_At"
-            ])
-            st.success("✅ Лист Content_Plan создан!")
-    except Exception as e:
-        st.error(f"❌ Ошибка при проверке Content_Plan: {e}")
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self.stats['rejected'] += 1
+            raise
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+        self.stats['requests'] += 1
+
+    def _retry_delay(self, error, attempt):
+        """Пауза перед следующей попыткой после ошибки error; если повторять нельзя — error пробрасывается"""
+        retry_after = None
+        if isinstance(error, httpx.HTTPStatusError):
+            status = error.response.status_code
+            if status not in LLM_RETRY_STATUSES:
+                # API отвечает — ошибка в самом запросе, повтор не поможет
+                self.breaker.record_success()
+                raise error
+            retry_after = parse_retry_after(error.response)
+            if status == 429:
+                self.stats['rate_limited'] += 1
+                self.bucket.pause(retry_after if retry_after is not None else self._backoff(attempt))
+            else:
+                self.breaker.record_failure()
+        else:
+            self.breaker.record_failure()
+
+        if attempt >= LLM_MAX_ATTEMPTS:
+            raise error
+        self.stats['retries'] += 1
+        return retry_after if retry_after is not None else self._backoff(attempt)
+
+    @staticmethod
+    def _backoff(attempt):
+        return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+    async def achat(self, messages, metrics=None, **params):
+        """POST /v1/chat/completions с повторами, возвращает JSON-ответ API.
+
+        Если передан словарь metrics, в него записываются attempts, ttfb (до заголовков
+        ответа удачной попытки) и latency (весь вызов вместе с паузами между попытками), в секундах.
+        """
+        call_started = time.perf_counter()
+        for attempt in range(1, LLM_MAX_ATTEMPTS + 1):
+            await self._before_attempt()
+            attempt_started = time.perf_counter()
+            try:
+                async with self._client.stream(
+                        "POST",
+                        "/v1/chat/completions",
+                        json={"model": DEEPSEEK_MODEL, "messages": messages, **params}
+                ) as response:
+                    ttfb = time.perf_counter() - attempt_started
+                    await response.aread()
+                    response.raise_for_status()
+                data = response.json()
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                delay = self._retry_delay(e, attempt)
+            except Exception:
+                # битый ответ или сбой на нашей стороне — тоже неудача для размыкателя
+                self.breaker.record_failure()
+                raise
+            else:
+                self.breaker.record_success()
+                if metrics is not None:
+                    metrics.update(attempts=attempt, ttfb=ttfb, latency=time.perf_counter() - call_started)
+                return data
+            finally:
+                # отмена (CancelledError) не даёт вердикта, но пробный запрос должен освободиться
+                self.breaker.release_trial()
+            await asyncio.sleep(delay)
+
+    async def astream_chat(self, messages, metrics=None, **params):
+        """Потоковый POST /v1/chat/completions (stream: true), отдаёт фрагменты текста ответа.
+
+        Если передан словарь metrics, в него записываются usage (расход токенов из последнего
+        чанка), attempts, ttfb (до первого фрагмента) и latency — как в achat().
+        Повтор возможен только до первого фрагмента: начатый поток не перезапускается.
+        """
+        payload = {
+            "model": DEEPSEEK_MODEL,
+            "messages": messages,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            **params
+        }
+        metrics = metrics if metrics is not None else {}
+        call_started = time.perf_counter()
+        for attempt in range(1, LLM_MAX_ATTEMPTS + 1):
+            await self._before_attempt()
+            attempt_started = time.perf_counter()
+            started = False
+            try:
+                async with self._client.stream("POST", "/v1/chat/completions", json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        if chunk.get('usage'):
+                            metrics['usage'] = chunk['usage']
+                        for choice in chunk.get('choices', []):
+                            delta = choice.get('delta', {}).get('content')
+                            if delta:
+                                if not started:
+                                    started = True
+                                    metrics['ttfb'] = time.perf_counter() - attempt_started
+                                yield delta
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                if started:
+                    self.breaker.record_failure()
+                    raise
+                delay = self._retry_delay(e, attempt)
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            else:
+                self.breaker.record_success()
+                metrics.update(attempts=attempt, latency=time.perf_counter() - call_started)
+                return
+            finally:
+                # закрытие генератора потребителем или отмена future в stream_chat
+                self.breaker.release_trial()
+            await asyncio.sleep(delay)
+
+    def stream_chat(self, messages, metrics=None, **params):
+        """Синхронный итератор по фрагментам потокового ответа для кода страниц"""
+        chunks = queue.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                async for delta in self.astream_chat(messages, metrics=metrics, **params):
+                    chunks.put(delta)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(finished)
+
+        future = self.submit(pump())
+        try:
+            while (item := chunks.get()) is not finished:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    def close(self):
+        """Закрыть соединения пула и остановить event loop"""
+        if not self._loop.is_running():
+            return
+        try:
+            self.run(self._client.aclose(), timeout=5)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+@st.cache_resource
+def get_llm_transport(api_key):
+    """Один транспорт DeepSeek на процесс"""
+    return LLMTransport(api_key)
 
 
-def ensure_prompts_sheet(client):
-    """Проверка наличия листа Prompts"""
+# --- КЭШ ОТВЕТОВ DEEPSEEK ---
+
+class LLMResponseCache:
+    """Дисковый кэш ответов DeepSeek, адресуемый хэшем запроса.
+
+    Ключ — SHA-256 от модели, сообщений (системный и пользовательский промпты) и параметров.
+    Записи живут LLM_CACHE_TTL секунд; сверх LLM_CACHE_MAX_ENTRIES вытесняются давно не читанные.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used_at);
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+
+    @staticmethod
+    def make_key(messages, params):
+        payload = json.dumps(
+            {"model": DEEPSEEK_MODEL, "messages": messages, "params": params},
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Текст ответа из кэша или None (просроченные записи удаляются)"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT content, total_tokens, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._bump('misses')
+                return None
+
+            self._conn.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key))
+            self._bump('hits')
+            self._bump('saved_tokens', row[1])
+            return row[0]
+
+    def put(self, key, content, total_tokens=0):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT OR REPLACE INTO responses (key, content, total_tokens, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, content, total_tokens, now, now))
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            self._conn.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    def stats(self):
+        """Счётчики для Dashboard: hits, misses, saved_tokens, entries"""
+        with self._lock:
+            stats = dict(self._conn.execute("SELECT name, value FROM cache_stats").fetchall())
+            stats['entries'] = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {name: stats.get(name, 0) for name in ('hits', 'misses', 'saved_tokens', 'entries')}
+
+    def _bump(self, name, amount=1):
+        self._conn.execute("""
+            INSERT INTO cache_stats (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+        """, (name, amount))
+
+
+@st.cache_resource
+def get_llm_cache():
+    """Один кэш ответов DeepSeek на процесс"""
+    return LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES)
+
+
+def llm_call_cost(usage):
+    """Стоимость вызова в USD по usage из ответа DeepSeek"""
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    cache_hit = usage.get('prompt_cache_hit_tokens', 0)
+    cache_miss = usage.get('prompt_cache_miss_tokens', prompt_tokens - cache_hit)
+    return (
+        cache_hit * DEEPSEEK_PRICE_PER_M_TOKENS['cache_hit']
+        + cache_miss * DEEPSEEK_PRICE_PER_M_TOKENS['cache_miss']
+        + usage.get('completion_tokens', 0) * DEEPSEEK_PRICE_PER_M_TOKENS['output']
+    ) / 1_000_000
+
+
+class LLMMetricsStore:
+    """Журнал вызовов DeepSeek в SQLite: токены, кэш DeepSeek, TTFB, длительность, повторы, Prompt_ID.
+
+    Одна строка на оплаченный ответ (ответы из локального кэша сюда не попадают).
+    Записи старше LLM_METRICS_RETENTION удаляются при записи.
+    """
+
+    COLUMNS = ('created_at', 'prompt_id', 'kind', 'stream', 'prompt_tokens', 'completion_tokens',
+               'cache_hit_tokens', 'ttfb', 'latency', 'retries', 'cost')
+
+    def __init__(self, path, retention):
+        self.retention = retention
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (
+                created_at REAL NOT NULL,
+                prompt_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                stream INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                cache_hit_tokens INTEGER NOT NULL,
+                ttfb REAL,
+                latency REAL NOT NULL,
+                retries INTEGER NOT NULL,
+                cost REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_calls_created_at ON calls (created_at);
+        """)
+
+    def record(self, prompt_id, kind, stream, metrics):
+        """Запись вызова по словарю metrics от LLMTransport (usage, attempts, ttfb, latency)"""
+        usage = metrics.get('usage') or {}
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                now, prompt_id, kind, int(stream),
+                usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0),
+                usage.get('prompt_cache_hit_tokens', 0),
+                metrics.get('ttfb'), metrics.get('latency', 0.0), metrics.get('attempts', 1) - 1,
+                llm_call_cost(usage)
+            ))
+            self._conn.execute("DELETE FROM calls WHERE created_at < ?", (now - self.retention,))
+
+    def calls(self, since):
+        """Вызовы с момента since (unix time) — список словарей по COLUMNS"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM calls WHERE created_at >= ? ORDER BY created_at", (since,)
+            ).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+
+@st.cache_resource
+def get_llm_metrics():
+    """Один журнал вызовов DeepSeek на процесс"""
+    return LLMMetricsStore(LLM_METRICS_PATH, LLM_METRICS_RETENTION)
+
+
+# --- РАЗБОР ОТВЕТОВ DEEPSEEK ---
+
+class ModelOutputError(ValueError):
+    """Ответ модели не удалось разобрать или починить до ожидаемой формы"""
+
+
+def repair_json_text(text, optional=()):
+    """Починка типичных дефектов JSON от модели.
+
+    Убирает обёртку ```json вокруг всего ответа, текст до и после объекта, висячие запятые,
+    экранирует переводы строк внутри строк и закрывает скобки, если ответ оборвался между
+    значениями. Оборванную строку не дописываем — это был бы обрезанный пост; но если
+    оборвалось поле верхнего уровня из optional (или его имя), поле отбрасывается целиком.
+    """
+    # Только обёртка всего ответа: ``` внутри строки JSON (пример кода в посте) не трогаем
+    stripped = text.strip()
+    if stripped.startswith("```"):
+        text = re.sub(r"^```(?:json)?", "", stripped, flags=re.I)
+        if text.endswith("```"):
+            text = text[:-3]
+    start = text.find('{')
+    if start < 0:
+        raise ModelOutputError("в ответе нет JSON-объекта")
+
+    out = []
+    closers = []
+    in_string = escape = False
+    member_start = member_key = key_chars = value_key = None
+    for char in text[start:]:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+                if key_chars is not None:
+                    member_key, key_chars = "".join(key_chars), None
+            elif char in '\n\r\t':
+                char = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}[char]
+            if in_string and key_chars is not None:
+                key_chars.append(char)
+            out.append(char)
+            continue
+        if char == '"':
+            in_string = True
+            value_key = None
+            # Поле верхнего уровня: запоминаем, где оно начинается, чтобы его можно было отбросить
+            if len(closers) == 1:
+                previous = _last_significant(out)
+                if previous in '{,':
+                    member_start, key_chars = len(out), []
+                elif previous == ':':
+                    value_key = member_key
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]':
+            _strip_trailing_comma(out)
+            if not closers or closers.pop() != char:
+                raise ModelOutputError("несогласованные скобки в JSON")
+            out.append(char)
+            if not closers:
+                return "".join(out)
+            continue
+        out.append(char)
+
+    if len(closers) == 1 and member_start is not None and (
+            (in_string and (key_chars is not None or value_key in optional))
+            or (not in_string and _last_significant(out) == ':' and member_key in optional)):
+        del out[member_start:]
+        in_string = False
+    if in_string:
+        raise ModelOutputError("ответ оборвался посреди строки")
+    _strip_trailing_comma(out)
+    if "".join(out).rstrip().endswith(':'):
+        raise ModelOutputError("ответ оборвался посреди поля")
+    return "".join(out) + "".join(reversed(closers))
+
+
+def _last_significant(out):
+    """Последний непробельный символ уже собранного JSON ('' — если его нет)"""
+    for char in reversed(out):
+        if not char.isspace():
+            return char
+    return ''
+
+
+def _strip_trailing_comma(out):
+    """Убрать висячую запятую (и пробелы перед ней) в конце собранного JSON"""
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ',':
+        out.pop()
+
+
+def validate_model_output(result, schema):
+    """Проверка формы ответа по схеме; возвращает (result, были_ли_исправления).
+
+    Безопасные расхождения исправляются на месте: число вместо строки, "8,5" вместо 8.5,
+    рекомендации одной строкой вместо списка, отсутствие необязательного поля.
+    """
+    if not isinstance(result, dict):
+        raise ModelOutputError("ответ не JSON-объект")
+
+    fixed = False
+    for field, (expected, default) in schema.items():
+        value = result.get(field)
+        if value is None:
+            if default is None:
+                raise ModelOutputError(f"в ответе нет поля {field}")
+            result[field] = type(default)(default)
+            fixed = True
+        elif expected is str and not isinstance(value, str):
+            if not isinstance(value, (int, float)):
+                raise ModelOutputError(f"поле {field} должно быть строкой")
+            result[field] = str(value)
+            fixed = True
+        elif expected is float and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            try:
+                result[field] = float(str(value).replace(',', '.').split('/')[0])
+            except ValueError:
+                raise ModelOutputError(f"поле {field} должно быть числом")
+            fixed = True
+        elif expected is list and not isinstance(value, list):
+            if not isinstance(value, str):
+                raise ModelOutputError(f"поле {field} должно быть списком")
+            result[field] = [line.strip().lstrip('-•').strip() for line in value.splitlines() if line.strip()]
+            fixed = True
+        elif expected is dict and not isinstance(value, dict):
+            raise ModelOutputError(f"поле {field} должно быть объектом")
+    return result, fixed
+
+
+def parse_model_output(content, schema):
+    """JSON-ответ модели → словарь по схеме; чинит, что можно, и учитывает исход в output_stats"""
     try:
-        spreadsheet = client.open_by_key(SHEET_ID)
         try:
-            worksheet = spreadsheet.worksheet("Prompts")
-            headers = worksheet.row_values(1)
-            if not headers or len(headers) < 4:
-                st.warning("⚠️ Проверьте структуру листа Prompts")
-        except gspread.WorksheetNotFound:
-            st.info("📋 Создаю лист Prompts...")
-            worksheet = spreadsheet.add_worksheet(title="Prompts", rows="50", cols="4")
-            worksheet.append_row(["Prompt_ID", "Prompt_Name", "Prompt_Text", "Active"])
-
-            # Добавляем промпты по умолчанию
-            default_prompts = [
-                ["system_base", "Системный промпт",
-                 "Ты — SMM-маркетолог для элитной клиники косметологии 'Шарм'.\n\nTone-of-Voice: {tone_of_voice}\nАдрес: {address}\nЗапрещенные слова: {blacklist_words}\nЦелевая аудитория: {age} лет\n\nТвоя задача — написать тексты для поста в VK и Telegram.\n\nВАЖНО: ВСЕГДА заканчивай посты призывом к действию и ссылкой для записи: {appointment_url}\n\nВерни ответ ТОЛЬКО в формате JSON:\n{{\n  \"vk_post\": \"Подробный текст для VK с эмодзи и призывом к действию\",\n  \"tg_post\": \"Короткий емкий текст для Telegram с призывом\",\n  \"image_prompt\": \"Детальный промпт для генерации изображения на русском языке (максимум 500 символов, фотореалистичный стиль, без текста на изображении)\"\n}}",
-                 "TRUE"],
-
-                ["promo_post", "Рекламный пост",
-                 "Задача: Рекламный пост\n\nУслуга: {service_name}\nОписание: {service_description}\nОборудование: {service_equipment}\nКлючевые слова: {service_keywords}\nАкция: {discount_text}\n{promo_code}\n\nСгенерируй тексты и промпт для изображения (косметология, процедура, атмосфера салона).",
-                 "TRUE"],
-
-                ["educational_post", "Познавательный пост",
-                 "Задача: Познавательный пост\n\nТема: {theme}\n\nВажно: Сделай пост интересным для аудитории {age} лет.\nВ конце мягко пригласи на консультацию и добавь ссылку.\n\nДля image_prompt создай описание изображения связанного с темой (например: красивая кожа, косметология, натуральная красота, wellness, SPA-атмосфера).",
-                 "TRUE"],
-
-                ["analysis_prompt", "Анализ поста",
-                 "Ты — эксперт по SMM для салонов красоты и косметологии.\nПроанализируй созданный пост и дай конкретные советы по улучшению.\n\nОцени по критериям (оценка от 1 до 10):\n1. headline_score - Привлекательность заголовка/первого предложения\n2. cta_score - Ясность и сила призыва к действию\n3. emotion_score - Эмоциональная вовлеченность\n4. emoji_score - Использование эмодзи (оптимально = 8-9, слишком много = 3-5)\n5. length_score - Оптимальность длины текста\n\nДай 3-4 КОНКРЕТНЫХ совета как улучшить пост.\nСоветы должны быть практичными и применимыми.\n\nВерни ответ ТОЛЬКО в формате JSON:\n{{\n  \"scores\": {{\n    \"headline\": 8,\n    \"cta\": 9,\n    \"emotion\": 7,\n    \"emoji\": 8,\n    \"length\": 9\n  }},\n  \"overall_score\": 8.2,\n  \"suggestions\": [\n    \"Конкретный совет 1\",\n    \"Конкретный совет 2\",\n    \"Конкретный совет 3\"\n  ],\n  \"summary\": \"Краткая общая оценка поста (1-2 предложения)\"\n}}",
-                 "TRUE"],
-
-                ["improvement_prompt", "Улучшение поста",
-                 "ВАЖНО: Перепиши тексты постов с учетом следующих рекомендаций:\n\n{suggestions}\n\nСохрани общую структуру и ключевые элементы (промокод, призыв к действию, ссылку), но улучши тексты согласно советам выше.",
-                 "TRUE"]
-            ]
+            result, fixed = json.loads(content), False
+        except json.JSONDecodeError:
+            try:
+                optional = {field for field, (_, default) in schema.items() if default is not None}
+                result, fixed = json.loads(repair_json_text(content, optional)), True
+            except json.JSONDecodeError as e:
+                raise ModelOutputError(f"JSON не удалось починить: {e}")
+        result, coerced = validate_model_output(result, schema)
+    except ModelOutputError:
+        output_stats.record('failed')
+        raise
+    output_stats.record('repaired' if fixed or coerced else 'clean')
+    return result
 
-            for prompt in default_prompts:
-                worksheet.append_row(prompt)
 
-            st.success("✅ Лист Prompts создан с промптами по умолчанию!")
-    except Exception as e:
-        st.error(f"❌ Ошибка при проверке Prompts: {e}")
+class ModelOutputStats:
+    """Счётчики разбора ответов DeepSeek на процесс: без правок, после починки, нечинимые"""
 
+    OUTCOMES = ('clean', 'repaired', 'failed')
 
-# Инициализация клиентов
-client = get_gspread_client()
-services_df, discounts_df, general_info = load_data_from_sheets(client)
-ensure_content_plan_sheet(client)
-ensure_prompts_sheet(client)
+    def __init__(self):
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
 
-# Инициализация DeepSeek клиента
-try:
-    deepseek_client = httpx.Client(
-        base_url="https://api.deepseek.com",
-        headers={"Authorization": f"Bearer {st.secrets['DEEPSEEK_API_KEY']}"},
-        timeout=60
+    def record(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {outcome: self._counts[outcome] for outcome in self.OUTCOMES}
+        total = sum(stats.values())
+        stats['repair_rate'] = stats['repaired'] / total * 100 if total else 0.0
+        return stats
+
+
+@st.cache_resource
+def get_output_stats():
+    """Одни счётчики разбора ответов на процесс"""
+    return ModelOutputStats()
+
+
+# --- ФОНОВЫЕ ЗАДАЧИ ---
+
+class Job:
+    """Фоновая задача: статус, промежуточный прогресс и результат.
+
+    context — данные сессии, нужные, чтобы применить результат в новой сессии
+    после переподключения браузера (form_data, исходный пост).
+    """
+
+    def __init__(self, kind, label, context):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.label = label
+        self.context = context
+        self.status = 'running'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.status != 'running'
+
+    def report(self, **progress):
+        """Обновление прогресса из потока задачи (словарь заменяется целиком — читатель не видит полуобновлённый)"""
+        self.progress = {**self.progress, **progress}
+
+
+class JobQueue:
+    """Очередь фоновых задач процесса поверх пула потоков.
+
+    Сессия хранит только ID задачи: клик по другой кнопке, перезапуск скрипта или
+    переподключение браузера не прерывают запрос к DeepSeek и не теряют его результат.
+    """
+
+    def __init__(self, workers, ttl):
+        self.ttl = ttl
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, label, context, fn):
+        """Запуск fn(job) в пуле; возвращает Job сразу"""
+        job = Job(kind, label, context)
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ('running', 'done', 'failed')}
+
+    def _run(self, job, fn):
+        try:
+            job.result = fn(job)
+            job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+
+    def _purge(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_job_queue():
+    """Очередь фоновых задач: одна на процесс, общая для всех сессий"""
+    return JobQueue(JOB_WORKERS, JOB_TTL)
+
+
+# --- ПУБЛИКАТОР ---
+
+class Publisher:
+    """Публикация готовых постов Content_Plan в VK и Telegram точно по Publish_Time.
+
+    Работает в своём потоке и читает только реплику: при смене версии листа строки
+    со статусом Ready перекладываются в min-heap по времени публикации, поток спит
+    до ближайшего поста (но не дольше PUBLISHER_IDLE_INTERVAL). Все наступившие посты
+    публикуются параллельно, VK и Telegram — одновременно; статусы Published
+    записываются одним запросом. Если одна из сетей ответила ошибкой, повторяется только она.
+    """
+
+    def __init__(self, replica, config):
+        self.replica = replica
+        self.config = config
+        self.networks = [
+            network for network, keys in (('vk', ('vk_token', 'vk_group_id')), ('tg', ('tg_token', 'tg_chat_id')))
+            if all(config.get(key) for key in keys)
+        ]
+        self.stats = {'published': 0, 'failed': 0, 'status_writes': 0}
+        self.last_error = None
+        self.last_run_at = None
+
+        self._heap = []
+        self._posts = {}
+        self._version = None
+        self._sent = {}  # ID → сети, куда пост уже ушёл (при частичной ошибке не дублируем)
+        self._unsaved = set()  # опубликованы, но статус ещё не записан в таблицу
+        self._attempts = collections.Counter()
+        self._retry_at = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def next_due(self):
+        heap = self._heap
+        return heap[0][0] if heap else None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """Пересобрать очередь сейчас, не дожидаясь таймера"""
+        self._wake.set()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        http = httpx.AsyncClient(timeout=PUBLISH_TIMEOUT)
+        while True:
+            try:
+                if self._unsaved:
+                    self._save_statuses()
+                self._refresh()
+                due = self._pop_due(time.time())
+                if due:
+                    loop.run_until_complete(self._publish_batch(http, due))
+                    continue
+            except Exception as e:
+                self.last_error = str(e)
+
+            next_due = self.next_due
+            timeout = PUBLISHER_IDLE_INTERVAL if next_due is None else min(PUBLISHER_IDLE_INTERVAL, next_due - time.time())
+            self._wake.wait(max(0.0, timeout))
+            self._wake.clear()
+
+    def _refresh(self):
+        """Пересборка очереди из реплики, если лист Content_Plan изменился"""
+        version = self.replica.version("Content_Plan")
+        if version == self._version:
+            return
+
+        ready = [post for post in self.replica.records("Content_Plan") if str(post.get('Status')) == 'Ready']
+        times = pd.to_datetime(
+            pd.Series([str(post.get('Publish_Time', '')) for post in ready], dtype=object),
+            format='mixed', errors='coerce'
+        )
+        heap = []
+        posts = {}
+        for post, publish_time in zip(ready, times):
+            post_id = str(post.get('ID', ''))
+            if (pd.isna(publish_time) or not post_id or post_id in self._unsaved
+                    or self._attempts[post_id] >= PUBLISHER_MAX_ATTEMPTS):
+                continue
+            posts[post_id] = post
+            # Publish_Time без пояса — местное время сервера; Timestamp.timestamp() считал бы его UTC
+            heap.append((max(publish_time.to_pydatetime().timestamp(), self._retry_at.get(post_id, 0.0)), post_id))
+        heapq.heapify(heap)
+
+        self._posts, self._heap, self._version = posts, heap, version
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(self._posts[heapq.heappop(self._heap)[1]])
+        return due
+
+    async def _publish_batch(self, http, posts):
+        self.last_run_at = time.time()
+        results = await asyncio.gather(*(self._publish_post(http, post) for post in posts))
+        published = [str(post['ID']) for post, ok in zip(posts, results) if ok]
+        for post_id in published:
+            self._sent.pop(post_id, None)
+            self._attempts.pop(post_id, None)
+            self._retry_at.pop(post_id, None)
+        self._unsaved.update(published)
+        if self._unsaved:
+            self._save_statuses()
+
+    def _save_statuses(self):
+        """Статус Published для всех опубликованных постов — одним запросом.
+
+        При ошибке посты остаются в _unsaved (и вне очереди), запись повторится на следующем круге.
+        """
+        unsaved = sorted(self._unsaved)
+        errors = self.replica.update_fields_by_key("Content_Plan", {post_id: {'Status': 'Published'} for post_id in unsaved})
+        self.stats['status_writes'] += 1
+        # Удалённые из плана посты повторно не пишем; остальные ошибки — повторим на следующем круге
+        self._unsaved = {
+            post_id for post_id, error in errors.items() if not isinstance(error, RowConflictError)
+        }
+        if self._unsaved:
+            self.last_error = f"статус Published не записан: {', '.join(sorted(self._unsaved))}"
+
+    async def _publish_post(self, http, post):
+        post_id = str(post['ID'])
+        sent = self._sent.setdefault(post_id, set())
+        pending = [network for network in self.networks if network not in sent]
+        senders = {'vk': self._send_vk, 'tg': self._send_tg}
+        results = await asyncio.gather(*(senders[network](http, post) for network in pending), return_exceptions=True)
+
+        errors = []
+        for network, result in zip(pending, results):
+            if isinstance(result, Exception):
+                errors.append(f"{network}: {result}")
+            else:
+                sent.add(network)
+        if not errors:
+            self.stats['published'] += 1
+            return True
+
+        self.stats['failed'] += 1
+        self._attempts[post_id] += 1
+        self._retry_at[post_id] = time.time() + PUBLISHER_RETRY_DELAY
+        self._version = None  # вернуть пост в очередь со сдвигом на PUBLISHER_RETRY_DELAY
+        self.last_error = f"{post_id}: {'; '.join(errors)}"
+        return False
+
+    async def _send_vk(self, http, post):
+        response = await http.post(f"{self.config['vk_api_base']}/method/wall.post", data={
+            'access_token': self.config['vk_token'],
+            'v': VK_API_VERSION,
+            'owner_id': f"-{str(self.config['vk_group_id']).lstrip('-')}",
+            'from_group': 1,
+            'message': post.get('VK_Text', '')
+        })
+        response.raise_for_status()
+        payload = response.json()
+        if 'error' in payload:
+            raise RuntimeError(payload['error'].get('error_msg', payload['error']))
+
+    async def _send_tg(self, http, post):
+        response = await http.post(
+            f"{self.config['tg_api_base']}/bot{self.config['tg_token']}/sendMessage",
+            json={'chat_id': self.config['tg_chat_id'], 'text': post.get('TG_Text', '')}
+        )
+        payload = response.json()
+        if not payload.get('ok'):
+            raise RuntimeError(payload.get('description', f"HTTP {response.status_code}"))
+
+
+def publisher_config():
+    """Настройки публикатора из секретов; None, если публикатор выключен"""
+    if not st.secrets.get('PUBLISHER_ENABLED', False):
+        return None
+    return {
+        'vk_token': st.secrets.get('VK_TOKEN', ''),
+        'vk_group_id': st.secrets.get('VK_GROUP_ID', ''),
+        'vk_api_base': st.secrets.get('VK_API_BASE', VK_API_BASE).rstrip('/'),
+        'tg_token': st.secrets.get('TELEGRAM_BOT_TOKEN', ''),
+        'tg_chat_id': st.secrets.get('TELEGRAM_CHAT_ID', ''),
+        'tg_api_base': st.secrets.get('TELEGRAM_API_BASE', TELEGRAM_API_BASE).rstrip('/'),
+    }
+
+
+@st.cache_resource
+def get_publisher(_replica):
+    """Один публикатор на процесс (None, если PUBLISHER_ENABLED не включён)"""
+    config = publisher_config()
+    if config is None:
+        return None
+    publisher = Publisher(_replica, config)
+    publisher.start()
+    return publisher
+
+
+def allocate_post_ids(count=1):
+    """Новые уникальные ID постов вида POST_n (без чтения столбца ID из таблицы)"""
+    return replica.allocate_ids("Content_Plan", count)
+
+
+# Ожидаемая структура листов: название -> обязательные столбцы
+SHEET_SCHEMA = {
+    "Services": ["Name", "Category", "Description_for_AI", "Equipment_Used", "Keywords_for_AI", "Default_Age"],
+    "Discounts": ["Name_for_UI", "Description_for_AI", "Applicable_Category"],
+    "General_Info": ["Key", "Value"],
+    "Prompts": ["Prompt_ID", "Prompt_Name", "Prompt_Text", "Active"],
+    "Content_Plan": ["ID", "Publish_Time", "Status", "Post_Type", "VK_Text", "TG_Text", "Image_Prompt", "Created_At",
+                     REVISION_COLUMN],
+    SYNC_META_SHEET: ["Sheet", "Marker"],
+}
+
+# Листы, которые приложение создаёт само, если их нет
+AUTO_CREATED_SHEETS = ["Content_Plan", "Prompts", SYNC_META_SHEET]
+
+# Служебные столбцы, которые приложение дописывает в существующие листы само
+AUTO_ADDED_COLUMNS = {"Content_Plan": [REVISION_COLUMN]}
+
+# Листы, без которых приложение работает на значениях по умолчанию
+OPTIONAL_SHEETS = ["Discounts", "General_Info"]
+
+# Промпты по умолчанию для нового листа Prompts
+DEFAULT_PROMPTS = [
+    ["system_base", "Системный промпт",
+     "Ты — SMM-маркетолог для элитной клиники косметологии 'Шарм'.\n\nTone-of-Voice: {tone_of_voice}\nАдрес: {address}\nЗапрещенные слова: {blacklist_words}\nЦелевая аудитория: {age} лет\n\nТвоя задача — написать тексты для поста в VK и Telegram.\n\nВАЖНО: ВСЕГДА заканчивай посты призывом к действию и ссылкой для записи: {appointment_url}\n\nВерни ответ ТОЛЬКО в формате JSON:\n{{\n  \"vk_post\": \"Подробный текст для VK с эмодзи и призывом к действию\",\n  \"tg_post\": \"Короткий емкий текст для Telegram с призывом\",\n  \"image_prompt\": \"Детальный промпт для генерации изображения на русском языке (максимум 500 символов, фотореалистичный стиль, без текста на изображении)\"\n}}",
+     "TRUE"],
+
+    ["promo_post", "Рекламный пост",
+     "Задача: Рекламный пост\n\nУслуга: {service_name}\nОписание: {service_description}\nОборудование: {service_equipment}\nКлючевые слова: {service_keywords}\nАкция: {discount_text}\n{promo_code}\n\nСгенерируй тексты и промпт для изображения (косметология, процедура, атмосфера салона).",
+     "TRUE"],
+
+    ["educational_post", "Познавательный пост",
+     "Задача: Познавательный пост\n\nТема: {theme}\n\nВажно: Сделай пост интересным для аудитории {age} лет.\nВ конце мягко пригласи на консультацию и добавь ссылку.\n\nДля image_prompt создай описание изображения связанного с темой (например: красивая кожа, косметология, натуральная красота, wellness, SPA-атмосфера).",
+     "TRUE"],
+
+    ["analysis_prompt", "Анализ поста",
+     "Ты — эксперт по SMM для салонов красоты и косметологии.\nПроанализируй созданный пост и дай конкретные советы по улучшению.\n\nОцени по критериям (оценка от 1 до 10):\n1. headline_score - Привлекательность заголовка/первого предложения\n2. cta_score - Ясность и сила призыва к действию\n3. emotion_score - Эмоциональная вовлеченность\n4. emoji_score - Использование эмодзи (оптимально = 8-9, слишком много = 3-5)\n5. length_score - Оптимальность длины текста\n\nДай 3-4 КОНКРЕТНЫХ совета как улучшить пост.\nСоветы должны быть практичными и применимыми.\n\nВерни ответ ТОЛЬКО в формате JSON:\n{{\n  \"scores\": {{\n    \"headline\": 8,\n    \"cta\": 9,\n    \"emotion\": 7,\n    \"emoji\": 8,\n    \"length\": 9\n  }},\n  \"overall_score\": 8.2,\n  \"suggestions\": [\n    \"Конкретный совет 1\",\n    \"Конкретный совет 2\",\n    \"Конкретный совет 3\"\n  ],\n  \"summary\": \"Краткая общая оценка поста (1-2 предложения)\"\n}}",
+     "TRUE"],
+
+    ["improvement_prompt", "Улучшение поста",
+     "ВАЖНО: Перепиши тексты постов с учетом следующих рекомендаций:\n\n{suggestions}\n\nСохрани общую структуру и ключевые элементы (промокод, призыв к действию, ссылку), но улучши тексты согласно советам выше.",
+     "TRUE"]
+]
+
+
+def fetch_sheet_headers(spreadsheet, sheet_names):
+    """Заголовки листов одним запросом метаданных: {название: [столбцы]} только для существующих листов"""
+    fields = "sheets(properties(title),data(rowData(values(formattedValue))))"
+
+    def request(names):
+        if not names:
+            return []
+        metadata = spreadsheet.fetch_sheet_metadata(params={
+            "includeGridData": "true",
+            "ranges": [absolute_range_name(name, "1:1") for name in names],
+            "fields": fields
+        })
+        return metadata.get('sheets', [])
+
+    try:
+        sheets = request(sheet_names)
+    except gspread.exceptions.APIError:
+        # Диапазон на несуществующий лист ломает весь запрос — уточняем список листов и повторяем
+        titles = {
+            sheet['properties']['title']
+            for sheet in spreadsheet.fetch_sheet_metadata(params={"fields": "sheets.properties.title"})['sheets']
+        }
+        sheets = request([name for name in sheet_names if name in titles])
+
+    headers = {}
+    for sheet in sheets:
+        row_data = (sheet.get('data') or [{}])[0].get('rowData') or [{}]
+        values = [cell.get('formattedValue', '') for cell in row_data[0].get('values', [])]
+        while values and not values[-1]:
+            values.pop()
+        headers[sheet['properties']['title']] = values
+    return headers
+
+
+def sync_marker_formula(sheet):
+    """Формула маркера изменений листа: число строк и контрольная сумма всего содержимого A:Z.
+
+    Каждая строка склеивается в текст, коды всех символов суммируются с весом позиции,
+    суммы строк — с весом номера строки (по модулю простого числа, чтобы число оставалось
+    точным). Маркер меняется от правки любого символа, а не только длины или первой буквы.
+    Google Sheets пересчитывает её при любой правке, поэтому реплике достаточно
+    прочитать одну ячейку, чтобы понять, нужно ли выгружать лист целиком.
+    """
+    cells = absolute_range_name(sheet, "A:Z")
+    return (
+        f'=LET(sums, BYROW({cells}, LAMBDA(r, LET(t, TEXTJOIN(CHAR(31), FALSE, r), n, LEN(t), '
+        f'MOD(SUMPRODUCT(UNICODE(MID(t, SEQUENCE(n), 1)), SEQUENCE(n)), 1000000007)))), '
+        f'COUNTA({absolute_range_name(sheet, "A:A")})'
+        f'&"|"&SUMPRODUCT(MOD(sums * SEQUENCE(ROWS(sums)), 1000000007)))'
+    )
+
+
+def refresh_sync_markers(spreadsheet):
+    """Переписать формулы маркеров прежнего вида (суммы по первым символам); True, если переписаны"""
+    rows = [[sheet, sync_marker_formula(sheet)] for sheet in REPLICA_SHEETS]
+    current = spreadsheet.values_get(
+        absolute_range_name(SYNC_META_SHEET, "A2:B"), params={'valueRenderOption': 'FORMULA'}
+    ).get('values', [])
+    if ([row[0] for row in current if row] == REPLICA_SHEETS
+            and all(len(row) >= 2 and 'UNICODE(' in row[1].upper() for row in current)):
+        return False
+    spreadsheet.values_update(
+        absolute_range_name(SYNC_META_SHEET, "A2"), params={'valueInputOption': 'USER_ENTERED'}, body={'values': rows}
+    )
+    return True
+
+
+def create_worksheet(spreadsheet, name):
+    """Создание листа с заголовками (промптами по умолчанию для Prompts, формулами маркеров для служебного листа)"""
+    columns = SHEET_SCHEMA[name]
+    rows = [columns]
+    if name == "Prompts":
+        rows += DEFAULT_PROMPTS
+    elif name == SYNC_META_SHEET:
+        rows += [[sheet, sync_marker_formula(sheet)] for sheet in REPLICA_SHEETS]
+
+    worksheet = spreadsheet.add_worksheet(title=name, rows=str(max(100, len(rows) + 50)), cols=str(len(columns)))
+    if name == SYNC_META_SHEET:
+        worksheet.append_rows(rows, value_input_option='USER_ENTERED')
+        worksheet.hide()
+    else:
+        worksheet.append_rows(rows)
+    return worksheet
+
+
+def add_missing_columns(spreadsheet, name, headers, columns):
+    """Дописать недостающие служебные столбцы справа от существующих заголовков"""
+    worksheet = spreadsheet.worksheet(name)
+    if worksheet.col_count < len(headers) + len(columns):
+        worksheet.add_cols(len(headers) + len(columns) - worksheet.col_count)
+    first = rowcol_to_a1(1, len(headers) + 1)
+    worksheet.update(range_name=first, values=[columns])
+    return headers + columns
+
+
+@st.cache_resource
+def ensure_schema(_client):
+    """Проверка структуры всех листов: выполняется один раз на процесс или по кнопке в настройках"""
+    spreadsheet = _client.open_by_key(SHEET_ID)
+    headers = fetch_sheet_headers(spreadsheet, list(SHEET_SCHEMA))
+
+    created = []
+    for name in AUTO_CREATED_SHEETS:
+        if name not in headers:
+            create_worksheet(spreadsheet, name)
+            headers[name] = list(SHEET_SCHEMA[name])
+            created.append(name)
+
+    if SYNC_META_SHEET in headers and SYNC_META_SHEET not in created and refresh_sync_markers(spreadsheet):
+        created.append(f"{SYNC_META_SHEET}: формулы маркеров")
+
+    for name, columns in AUTO_ADDED_COLUMNS.items():
+        missing = [column for column in columns if name in headers and column not in headers[name]]
+        if missing:
+            headers[name] = add_missing_columns(spreadsheet, name, headers[name], missing)
+            created.append(f"{name}: {', '.join(missing)}")
+
+    sheets = {}
+    issues = []
+    for name, columns in SHEET_SCHEMA.items():
+        sheet_headers = headers.get(name)
+        missing = [column for column in columns if column not in (sheet_headers or [])]
+        sheets[name] = {
+            'exists': sheet_headers is not None,
+            'headers': sheet_headers or [],
+            'missing_columns': missing if sheet_headers is not None else list(columns),
+        }
+        if sheet_headers is None:
+            if name not in OPTIONAL_SHEETS:
+                issues.append(f"Лист '{name}' не найден")
+        elif missing:
+            issues.append(f"Проверьте структуру листа {name}. Не хватает столбцов: {', '.join(missing)}")
+
+    fingerprint_source = json.dumps(
+        {name: info['headers'] for name, info in sheets.items()}, ensure_ascii=False, sort_keys=True
     )
+    return {
+        'fingerprint': hashlib.sha1(fingerprint_source.encode('utf-8')).hexdigest()[:12],
+        'checked_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'sheets': sheets,
+        'issues': issues,
+        'created': created,
+    }
+
+
+class AppContext:
+    """Всё, что приложению нужно на весь процесс: клиенты, схема, реплика, DeepSeek.
+
+    Создаётся один раз в get_app_context; повторные прогоны скрипта получают готовый
+    объект одним обращением к кэшу. Здесь же копится статистика прогонов для страницы состояния.
+    """
+
+    def __init__(self, api_key):
+        self.created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.bootstrap_timings = {}
+
+        self.client = self._timed("Google Sheets: авторизация", get_gspread_client)
+        self.schema, self.schema_error = self._timed("Проверка структуры таблицы", self._check_schema)
+        self._schema_checked_at = time.time()
+        self._schema_retry = None
+        self._schema_lock = threading.Lock()
+        self.replica = self._timed("Реплика: первая синхронизация", lambda: get_replica(self.client))
+        self.llm = self._timed("DeepSeek: транспорт", lambda: get_llm_transport(api_key))
+        self.llm_cache = self._timed("DeepSeek: кэш ответов", get_llm_cache)
+        self.llm_metrics = self._timed("DeepSeek: журнал вызовов", get_llm_metrics)
+        self.output_stats = get_output_stats()
+        self.jobs = self._timed("Очередь фоновых задач", get_job_queue)
+        self.publisher = self._timed("Публикатор", lambda: get_publisher(self.replica))
+
+        self._runs_lock = threading.Lock()
+        self._runs = collections.deque(maxlen=RUN_HISTORY_SIZE)
+        self._writes = collections.deque(maxlen=RUN_HISTORY_SIZE)
+
+    def _timed(self, label, factory):
+        started = time.perf_counter()
+        result = factory()
+        self.bootstrap_timings[label] = time.perf_counter() - started
+        return result
+
+    def _check_schema(self):
+        try:
+            return ensure_schema(self.client), None
+        except Exception as e:
+            return None, str(e)
+
+    def revalidate_schema(self):
+        """Повторная проверка структуры таблицы (кнопка в настройках)"""
+        ensure_schema.clear()
+        self.schema, self.schema_error = self._check_schema()
+        self._schema_checked_at = time.time()
+        return self.schema
+
+    def retry_schema(self):
+        """Повтор неудавшейся проверки структуры в фоне, не чаще раза в SYNC_INTERVAL: прогоны не ждут Google"""
+        with self._schema_lock:
+            if self._schema_retry is not None and self._schema_retry.is_alive():
+                return
+            if time.time() - self._schema_checked_at < SYNC_INTERVAL:
+                return
+            self._schema_checked_at = time.time()
+            self._schema_retry = threading.Thread(target=self.revalidate_schema, name="schema-retry", daemon=True)
+            self._schema_retry.start()
+
+    def record_run(self, page, bootstrap_seconds, total_seconds):
+        """Длительность завершившегося прогона скрипта: до меню (накладные расходы) и целиком"""
+        with self._runs_lock:
+            self._runs.append({'page': page, 'bootstrap': bootstrap_seconds, 'total': total_seconds})
+
+    def runs(self):
+        with self._runs_lock:
+            return list(self._runs)
+
+    def record_write(self, action, seconds):
+        """Длительность записи в таблицу со страницы — от нажатия кнопки до готовности к перезапуску"""
+        with self._runs_lock:
+            self._writes.append({'action': action, 'seconds': seconds})
+
+    def writes(self):
+        with self._runs_lock:
+            return list(self._writes)
+
+
+@st.cache_resource
+def get_app_context(api_key):
+    """Единая точка инициализации приложения (один раз на процесс)"""
+    return AppContext(api_key)
+
+
+try:
+    app = get_app_context(st.secrets['DEEPSEEK_API_KEY'])
 except KeyError as e:
     st.error(f"❌ Секрет не найден: {e}. Проверьте .streamlit/secrets.toml")
     st.stop()
 
+client, replica, llm, llm_cache, jobs = app.client, app.replica, app.llm, app.llm_cache, app.jobs
+llm_metrics, output_stats = app.llm_metrics, app.output_stats
+if app.schema is None:
+    # Проверка при запуске не удалась — повторяем в фоне, пока не получится
+    app.retry_schema()
+schema = app.schema
+
+if schema is None:
+    st.error(f"❌ Ошибка при проверке структуры таблицы: {app.schema_error}")
+else:
+    for issue in schema['issues']:
+        st.warning(f"⚠️ {issue}")
+
+services_df, discounts_df, general_info = load_data_from_sheets(client)
+
 
 # --- ФУНКЦИИ ГЕНЕРАЦИИ ---
 
+# Промпты: неизменяемый индекс Prompt_ID → PromptTemplate
+EMPTY_PROMPT_REGISTRY = MappingProxyType({})
+
+# Переменные, которые приложение подставляет в промпты (по Prompt_ID)
+POST_PROMPT_VARIABLES = frozenset({
+    'tone_of_voice', 'address', 'blacklist_words', 'age', 'appointment_url', 'promo_code',
+    'service_name', 'service_description', 'service_equipment', 'service_keywords', 'discount_text', 'theme'
+})
+PROMPT_VARIABLES = {
+    'system_base': POST_PROMPT_VARIABLES,
+    'promo_post': POST_PROMPT_VARIABLES,
+    'educational_post': POST_PROMPT_VARIABLES,
+    'analysis_prompt': frozenset(),
+    'improvement_prompt': frozenset({'suggestions'}),
+}
+ALL_PROMPT_VARIABLES = frozenset().union(*PROMPT_VARIABLES.values())
+
+
+class PromptTemplate:
+    """Шаблон промпта, разобранный один раз.
+
+    parts чередует литералы и имена переменных, поэтому render собирает текст за один
+    проход. Неизвестные переменные остаются в тексте как есть, как и у replace_variables.
+    """
+
+    PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+    def __init__(self, text, prompt_id='', name=''):
+        self.text = text
+        self.prompt_id = prompt_id
+        self.name = name
+        self.version = hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+        self.parts = self.PLACEHOLDER.split(text)
+        self.placeholders = frozenset(self.parts[1::2])
+        self.unknown = sorted(self.placeholders - PROMPT_VARIABLES.get(prompt_id, ALL_PROMPT_VARIABLES))
+
+    def render(self, variables):
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = str(variables[name]) if name in variables else f"{{{name}}}"
+        return ''.join(parts)
+
+
 def replace_variables(template, variables):
-    """Замена переменных в промпте"""
+    """Замена переменных в промпте (прежняя реализация: по str.replace на каждую переменную)"""
     result = template
     for key, value in variables.items():
         placeholder = f"{{{key}}}"
@@ -210,22 +2474,69 @@ def replace_variables(template, variables):
     return result
 
 
-def get_prompt_by_id(prompts_df, prompt_id):
-    """Получение промпта по ID"""
-    prompt_row = prompts_df[(prompts_df['Prompt_ID'] == prompt_id) & (prompts_df['Active'] == 'TRUE')]
-    if prompt_row.empty:
-        return None
-    return prompt_row.iloc[0]['Prompt_Text']
+def benchmark_prompt_rendering(template, variables, iterations=2000):
+    """Сравнение replace_variables и PromptTemplate.render на одном шаблоне: микросекунды на одну подстановку"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        replace_variables(template.text, variables)
+    legacy = time.perf_counter() - started
 
+    started = time.perf_counter()
+    for _ in range(iterations):
+        template.render(variables)
+    compiled = time.perf_counter() - started
+
+    return {
+        'legacy': legacy / iterations * 1e6,
+        'compiled': compiled / iterations * 1e6,
+        'same_output': replace_variables(template.text, variables) == template.render(variables),
+    }
 
-def build_prompt(post_type, age, promo_code, service_info, discount_info, theme, prompts_df):
+
+@st.cache_resource(max_entries=2)
+def build_prompt_registry(_replica, version):
+    """Индекс активных промптов, общий для всех сессий: строится один раз на версию листа Prompts.
+
+    Как и прежде, при нескольких активных строках с одним Prompt_ID берётся первая.
+    """
+    entries = {}
+    for row in _replica.records("Prompts"):
+        prompt_id = str(row.get('Prompt_ID', ''))
+        if str(row.get('Active', '')) != 'TRUE' or prompt_id in entries:
+            continue
+        entries[prompt_id] = PromptTemplate(
+            str(row.get('Prompt_Text', '')), prompt_id, str(row.get('Prompt_Name', ''))
+        )
+    return MappingProxyType(entries)
+
+
+def load_prompt_registry(_client):
+    """Индекс промптов из локальной реплики Google Sheets"""
+    try:
+        replica = get_replica(_client)
+        return build_prompt_registry(replica, replica.version("Prompts"))
+    except gspread.WorksheetNotFound:
+        st.warning("⚠️ Лист 'Prompts' не найден. Создайте его для настройки промптов.")
+        return EMPTY_PROMPT_REGISTRY
+    except Exception as e:
+        st.error(f"❌ Ошибка загрузки промптов: {e}")
+        return EMPTY_PROMPT_REGISTRY
+
+
+def get_prompt_by_id(prompts, prompt_id):
+    """Получение текста промпта по ID"""
+    template = prompts.get(prompt_id)
+    return template.text if template is not None else None
+
+
+def build_prompt(post_type, age, promo_code, service_info, discount_info, theme, prompts):
     """Сборка промпта для DeepSeek с использованием шаблонов из Sheets"""
 
     # Базовые переменные
     variables = {
-        'tone_of_voice': general_info.get('Tone_of_Voice', 'Профессионально и дружелюбно'),
-        'address': general_info.get('Address', 'Москва'),
-        'blacklist_words': general_info.get('Blacklist_Words', ''),
+        'tone_of_voice': general_info.get('Tone_of_Voice', GENERAL_INFO_DEFAULTS['Tone_of_Voice']),
+        'address': general_info.get('Address', GENERAL_INFO_DEFAULTS['Address']),
+        'blacklist_words': general_info.get('Blacklist_Words', GENERAL_INFO_DEFAULTS['Blacklist_Words']),
         'age': age,
         'appointment_url': APPOINTMENT_URL,
         'promo_code': '',
@@ -243,16 +2554,16 @@ def build_prompt(post_type, age, promo_code, service_info, discount_info, theme,
             'promo_code'] = f"КРИТИЧЕСКИ ВАЖНО ПРО ПРОМОКОД:\n- В тексте ОБЯЗАТЕЛЬНО должен быть промокод: {promo_code}\n- Для VK: \"Используйте промокод {promo_code} при записи для получения скидки!\"\n- Для TG: \"💎 Промокод: {promo_code}\"\n- Промокод должен быть выделен и заметен в тексте"
 
     # Получаем системный промпт
-    system_prompt_template = get_prompt_by_id(prompts_df, 'system_base')
+    system_prompt_template = prompts.get('system_base')
     if not system_prompt_template:
         st.error("❌ Не найден системный промпт (system_base)")
         return None, None
 
-    system_prompt = replace_variables(system_prompt_template, variables)
+    system_prompt = system_prompt_template.render(variables)
 
     # Получаем user промпт в зависимости от типа поста
     if post_type == "Рекламный":
-        user_prompt_template = get_prompt_by_id(prompts_df, 'promo_post')
+        user_prompt_template = prompts.get('promo_post')
         if not user_prompt_template:
             st.error("❌ Не найден промпт для рекламного поста")
             return None, None
@@ -272,49 +2583,346 @@ def build_prompt(post_type, age, promo_code, service_info, discount_info, theme,
             variables['promo_code'] = "Промокода нет, не упоминай его"
 
     else:  # Познавательный
-        user_prompt_template = get_prompt_by_id(prompts_df, 'educational_post')
+        user_prompt_template = prompts.get('educational_post')
         if not user_prompt_template:
             st.error("❌ Не найден промпт для познавательного поста")
             return None, None
 
-        variables['theme'] = theme if theme else 'косметология и уход за кожей'
+        variables['theme'] = theme if theme else 'косметология и уход за кожей'
+
+    user_prompt = user_prompt_template.render(variables)
+
+    return system_prompt, user_prompt
+
+
+def post_prompt_id(post_type):
+    """Prompt_ID шаблона пользовательского промпта для типа поста"""
+    return 'promo_post' if post_type == "Рекламный" else 'educational_post'
+
+
+class StreamingJSONFields:
+    """Инкрементальный разбор строковых полей JSON-объекта по мере прихода токенов.
+
+    Держит состояние между вызовами feed(), поэтому каждый фрагмент разбирается один раз.
+    Возвращает частично полученные значения — для предпросмотра, а не для сохранения.
+    """
+
+    ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', '\\': '\\', '/': '/'}
+
+    def __init__(self, fields):
+        self.fields = set(fields)
+        self.values = {}
+        self._state = 'seek_key'
+        self._key = []
+        self._target = None
+        self._escape = None
+        self._high_surrogate = None
+
+    def feed(self, chunk):
+        for char in chunk:
+            self._step(char)
+        return self.values
+
+    def _step(self, char):
+        state = self._state
+        if state == 'seek_key':
+            if char == '"':
+                self._key = []
+                self._state = 'key'
+        elif state == 'key':
+            if char == '"':
+                self._state = 'colon'
+            else:
+                self._key.append(char)
+        elif state == 'colon':
+            if char == ':':
+                self._state = 'value'
+        elif state == 'value':
+            if char == '"':
+                key = ''.join(self._key)
+                self._target = key if key in self.fields else None
+                if self._target:
+                    self.values[self._target] = ''
+                self._state = 'string'
+            elif not char.isspace():
+                self._state = 'scalar'
+        elif state == 'scalar':
+            if char in ',}':
+                self._state = 'seek_key'
+        elif state == 'string':
+            self._step_string(char)
+
+    def _step_string(self, char):
+        if self._escape is not None:
+            self._escape += char
+            if self._escape[0] != 'u':
+                self._append(self.ESCAPES.get(char, char))
+                self._escape = None
+            elif len(self._escape) == 5:
+                self._append_code_unit(int(self._escape[1:], 16))
+                self._escape = None
+        elif char == '\\':
+            self._escape = ''
+        elif char == '"':
+            self._state = 'seek_key'
+        else:
+            self._append(char)
+
+    def _append_code_unit(self, code):
+        if 0xD800 <= code < 0xDC00:
+            self._high_surrogate = code
+            return
+        if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+            code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+        self._high_surrogate = None
+        self._append(chr(code))
+
+    def _append(self, text):
+        if self._target:
+            self.values[self._target] += text
+
+
+def schema_kind(schema):
+    """Вид вызова для журнала по умолчанию: 'analysis' или 'generation'.
+
+    'generation' — только первый вызов поста, начатого пользователем: по ним считается
+    стоимость поста. Варианты, улучшения и повторы после битого JSON пишутся как
+    'candidate', 'improvement' и 'repeat'.
+    """
+    return 'analysis' if schema is ANALYSIS_SCHEMA else 'generation'
+
+
+async def arequest_json_completion(messages, schema, prompt_id, use_cache=True, kind=None):
+    """Запрос к DeepSeek через общий транспорт, ответ — JSON, проверенный по schema.
+
+    use_cache=False не читает кэш (регенерация), но свежий ответ в кэш всё равно записывается.
+    Повторный запрос делается, только если ответ не удалось починить (parse_model_output).
+    Каждый оплаченный ответ пишется в llm_metrics с prompt_id — Prompt_ID основного шаблона —
+    и видом kind (по умолчанию schema_kind(schema)).
+    """
+    kind = kind or schema_kind(schema)
+    params = {"response_format": {"type": "json_object"}}
+    cache_key = llm_cache.make_key(messages, params)
+    if use_cache:
+        cached = await asyncio.to_thread(llm_cache.get, cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+    for attempt in range(1, JSON_MAX_ATTEMPTS + 1):
+        metrics = {}
+        response = await llm.achat(messages, metrics=metrics, **params)
+        metrics['usage'] = response.get('usage', {})
+        # SQLite — в пуле потоков: запись журнала не должна останавливать event loop с остальными запросами
+        await asyncio.to_thread(llm_metrics.record, prompt_id, kind if attempt == 1 else 'repeat', False, metrics)
+        try:
+            result = parse_model_output(response['choices'][0]['message']['content'], schema)
+        except ModelOutputError:
+            if attempt == JSON_MAX_ATTEMPTS:
+                raise
+            continue
+        # В кэш — уже починенный ответ, чтобы попадания не разбирались заново
+        await asyncio.to_thread(
+            llm_cache.put, cache_key, json.dumps(result, ensure_ascii=False), response.get('usage', {}).get('total_tokens', 0)
+        )
+        return result
+
+
+def request_json_completion(messages, schema, prompt_id, use_cache=True, kind=None):
+    """Синхронная обёртка над arequest_json_completion для кода страниц"""
+    return llm.run(arequest_json_completion(messages, schema, prompt_id, use_cache=use_cache, kind=kind))
+
+
+def stream_json_completion(messages, on_update, prompt_id, use_cache=True):
+    """Потоковая генерация поста: on_update(поля) вызывается по мере прихода токенов, ответ — JSON по GENERATION_SCHEMA"""
+    params = {"response_format": {"type": "json_object"}}
+    cache_key = llm_cache.make_key(messages, params)
+    if use_cache:
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+    fields = StreamingJSONFields(GENERATION_FIELDS)
+    chunks = []
+    metrics = {}
+    for delta in llm.stream_chat(messages, metrics=metrics, **params):
+        chunks.append(delta)
+        on_update(fields.feed(delta))
+    llm_metrics.record(prompt_id, 'generation', True, metrics)
+
+    try:
+        result = parse_model_output("".join(chunks), GENERATION_SCHEMA)
+    except ModelOutputError:
+        # Починить не вышло — обычный запрос заново (он же запишет ответ в кэш)
+        return request_json_completion(messages, GENERATION_SCHEMA, prompt_id, use_cache=False, kind='repeat')
+    llm_cache.put(cache_key, json.dumps(result, ensure_ascii=False), metrics.get('usage', {}).get('total_tokens', 0))
+    return result
+
+
+def job_generate_post(job, system_prompt, user_prompt, prompt_id, stream):
+    """Фоновая задача: генерация поста; при stream частичные тексты публикуются в job.progress['preview']"""
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    if not stream:
+        return request_json_completion(messages, GENERATION_SCHEMA, prompt_id)
+
+    last_report = [0.0]
+
+    def update(values):
+        now = time.monotonic()
+        if now - last_report[0] >= STREAM_REFRESH_INTERVAL:
+            last_report[0] = now
+            job.report(preview=dict(values))
+
+    return stream_json_completion(messages, update, prompt_id)
+
+
+def job_generate_candidates(job, system_prompt, user_prompt, post_type, prompts, count, form_data):
+    """Фоновая задача: подбор лучшего варианта; статусы вариантов — в job.progress['statuses']"""
+    candidates = [{} for _ in range(count)]
+    statuses = [f"⏳ Вариант {index + 1}: генерация..." for index in range(count)]
+    job.report(statuses=list(statuses))
+
+    def on_event(index, stage, payload):
+        if stage == 'generated':
+            candidates[index]['content'] = apply_custom_image(payload, form_data)
+            statuses[index] = f"🔍 Вариант {index + 1}: анализ..."
+        elif stage == 'scored':
+            candidates[index]['analysis'] = payload
+            score = payload.get('overall_score', '—') if payload else '—'
+            statuses[index] = f"✅ Вариант {index + 1}: {score}/10"
+        else:
+            statuses[index] = f"❌ Вариант {index + 1}: {payload}"
+        job.report(statuses=list(statuses))
+
+    run_candidate_pipeline(system_prompt, user_prompt, post_type, prompts, count, on_event)
+
+    return sorted(
+        (candidate for candidate in candidates if candidate.get('content')),
+        key=candidate_score,
+        reverse=True
+    )
+
+
+def run_candidate_pipeline(system_prompt, user_prompt, post_type, prompts, count, on_event):
+    """Параллельная генерация count вариантов поста и их оценка через analysis_prompt.
+
+    Каждый кандидат проходит цепочку «генерация → анализ» независимо от остальных,
+    поэтому общее время ограничено самой медленной цепочкой, а не суммой вызовов.
+    on_event(index, stage, payload) вызывается в вызывающем потоке; stage — 'generated'
+    (payload — тексты), 'scored' (payload — анализ или None) или 'failed' (payload — ошибка).
+    """
+    analysis_prompt_template = get_prompt_by_id(prompts, 'analysis_prompt')
+    events = queue.Queue()
+
+    async def candidate(index):
+        try:
+            # Мимо кэша: одинаковый промпт должен дать разные варианты
+            content = await arequest_json_completion([
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ], GENERATION_SCHEMA, post_prompt_id(post_type), use_cache=False, kind='candidate')
+            events.put((index, 'generated', content))
+
+            analysis = None
+            if analysis_prompt_template:
+                analysis = await arequest_json_completion([
+                    {"role": "user", "content": build_analysis_prompt(
+                        analysis_prompt_template, content.get('vk_post', ''), content.get('tg_post', ''), post_type
+                    )}
+                ], ANALYSIS_SCHEMA, 'analysis_prompt')
+            events.put((index, 'scored', analysis))
+        except Exception as e:
+            events.put((index, 'failed', e))
+
+    for index in range(count):
+        llm.submit(candidate(index))
+
+    finished = 0
+    while finished < count:
+        index, stage, payload = events.get()
+        on_event(index, stage, payload)
+        if stage != 'generated':
+            finished += 1
+
+
+def candidate_score(candidate):
+    """Общая оценка кандидата для сортировки (без анализа — в конец списка)"""
+    try:
+        return float((candidate.get('analysis') or {}).get('overall_score', -1))
+    except (TypeError, ValueError):
+        return -1.0
+
+
+def apply_custom_image(content, form_data):
+    """Подставляет свою картинку или свой промпт картинки из формы вместо сгенерированного"""
+    if form_data.get('custom_image_url'):
+        content['image_prompt'] = f"[URL картинки: {form_data['custom_image_url']}]"
+    elif form_data.get('custom_image_prompt'):
+        content['image_prompt'] = form_data['custom_image_prompt']
+    return content
+
+
+def job_generate_batch(job, items):
+    """Фоновая задача: пакетная генерация; статусы постов — в job.progress['statuses']"""
+    statuses = [f"⏳ {item['Publish_Time']} | {item['label']}" for item in items]
+    done = [0]
+    job.report(statuses=list(statuses), done=0, total=len(items))
+
+    def on_item_done(index, content, error):
+        item = items[index]
+        done[0] += 1
+        if error is not None:
+            statuses[index] = f"❌ {item['Publish_Time']} | {item['label']} — {error}"
+        else:
+            item['content'] = content
+            statuses[index] = f"✅ {item['Publish_Time']} | {item['label']}"
+        job.report(statuses=list(statuses), done=done[0])
+
+    run_batch_generation(items, on_item_done)
 
-    user_prompt = replace_variables(user_prompt_template, variables)
+    return [
+        {key: item[key] for key in ('label', 'Post_Type', 'Publish_Time', 'Status', 'content')}
+        for item in items if item.get('content')
+    ]
 
-    return system_prompt, user_prompt
 
+def run_batch_generation(items, on_item_done):
+    """Параллельная генерация постов пакета с ограничением одновременных запросов.
 
-def generate_text_content(system_prompt, user_prompt):
-    """Генерация текста через DeepSeek"""
-    try:
-        response = deepseek_client.post(
-            "/v1/chat/completions",
-            json={
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "response_format": {"type": "json_object"}
-            }
-        )
-        response.raise_for_status()
-        content_json = response.json()['choices'][0]['message']['content']
-        return json.loads(content_json)
-    except Exception as e:
-        st.error(f"❌ Ошибка DeepSeek: {e}")
-        return None
+    items — список словарей с system_prompt/user_prompt; on_item_done(index, content, error)
+    вызывается в вызывающем потоке по мере готовности каждого поста. Повторы при 429/5xx,
+    общая пауза по Retry-After и ограничение частоты — в транспорте (LLMTransport).
+    """
+    events = queue.Queue()
+
+    async def generate_all():
+        # Семафор создаётся в event loop транспорта, а не в потоке вызывающего
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def generate(index, item):
+            async with semaphore:
+                try:
+                    content = await arequest_json_completion([
+                        {"role": "system", "content": item['system_prompt']},
+                        {"role": "user", "content": item['user_prompt']}
+                    ], GENERATION_SCHEMA, post_prompt_id(item['Post_Type']))
+                except Exception as e:
+                    events.put((index, None, e))
+                else:
+                    events.put((index, content, None))
 
+        await asyncio.gather(*(generate(index, item) for index, item in enumerate(items)))
 
-def analyze_post(vk_text, tg_text, post_type, prompts_df):
-    """Анализ поста через DeepSeek"""
-    try:
-        analysis_prompt_template = get_prompt_by_id(prompts_df, 'analysis_prompt')
-        if not analysis_prompt_template:
-            st.error("❌ Не найден промпт для анализа")
-            return None
+    llm.submit(generate_all())
+    for _ in items:
+        on_item_done(*events.get())
 
-        analysis_prompt = f"""{analysis_prompt_template}
+
+def build_analysis_prompt(analysis_prompt_template, vk_text, tg_text, post_type):
+    """Промпт анализа поста по шаблону analysis_prompt"""
+    return f"""{analysis_prompt_template}
 
 Тип поста: {post_type}
 
@@ -325,56 +2933,50 @@ Telegram текст:
 {tg_text}
 """
 
-        response = deepseek_client.post(
-            "/v1/chat/completions",
-            json={
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "user", "content": analysis_prompt}
-                ],
-                "response_format": {"type": "json_object"}
-            }
-        )
-        response.raise_for_status()
 
-        analysis_json = response.json()['choices'][0]['message']['content']
-        return json.loads(analysis_json)
+def analyze_post(vk_text, tg_text, post_type, prompts):
+    """Анализ поста через DeepSeek (выполняется в фоновой задаче, ошибки пробрасываются)"""
+    analysis_prompt_template = get_prompt_by_id(prompts, 'analysis_prompt')
+    if not analysis_prompt_template:
+        raise ValueError("не найден промпт для анализа (analysis_prompt)")
 
-    except Exception as e:
-        st.error(f"❌ Ошибка анализа поста: {e}")
-        return None
+    analysis_prompt = build_analysis_prompt(analysis_prompt_template, vk_text, tg_text, post_type)
 
+    return request_json_completion([
+        {"role": "user", "content": analysis_prompt}
+    ], ANALYSIS_SCHEMA, 'analysis_prompt')
 
-def improve_post_with_suggestions(vk_text, tg_text, suggestions, post_type, form_data, prompts_df):
-    """Улучшение поста с учетом рекомендаций AI"""
-    try:
-        suggestions_text = "\n".join([f"- {s}" for s in suggestions])
 
-        service_info_dict = form_data.get('service_info')
-        service_info_obj = pd.Series(service_info_dict) if service_info_dict else None
-        discount_info_dict = form_data.get('discount_info')
-        discount_info_obj = pd.Series(discount_info_dict) if discount_info_dict else None
+def build_prompt_from_form(form_data, prompts):
+    """Базовые промпты по сохранённым данным формы генерации"""
+    service_info_dict = form_data.get('service_info')
+    service_info_obj = pd.Series(service_info_dict) if service_info_dict else None
+    discount_info_dict = form_data.get('discount_info')
+    discount_info_obj = pd.Series(discount_info_dict) if discount_info_dict else None
 
-        # Базовый промпт
-        system_prompt, user_prompt = build_prompt(
-            form_data['Post_Type'],
-            form_data['age'],
-            form_data['promo_code'],
-            service_info_obj,
-            discount_info_obj,
-            form_data['theme'],
-            prompts_df
-        )
+    return build_prompt(
+        form_data['Post_Type'],
+        form_data['age'],
+        form_data['promo_code'],
+        service_info_obj,
+        discount_info_obj,
+        form_data['theme'],
+        prompts
+    )
 
-        # Получаем промпт для улучшения
-        improvement_template = get_prompt_by_id(prompts_df, 'improvement_prompt')
-        if not improvement_template:
-            st.error("❌ Не найден промпт для улучшения")
-            return None
 
-        improvement_instructions = replace_variables(improvement_template, {'suggestions': suggestions_text})
+def improve_post_with_suggestions(vk_text, tg_text, suggestions, system_prompt, user_prompt, prompts):
+    """Улучшение поста с учетом рекомендаций AI (выполняется в фоновой задаче, ошибки пробрасываются)"""
+    suggestions_text = "\n".join([f"- {s}" for s in suggestions])
+
+    # Получаем промпт для улучшения
+    improvement_template = prompts.get('improvement_prompt')
+    if not improvement_template:
+        raise ValueError("не найден промпт для улучшения (improvement_prompt)")
 
-        improvement_instructions += f"""
+    improvement_instructions = improvement_template.render({'suggestions': suggestions_text})
+
+    improvement_instructions += f"""
 
 Текущий VK пост:
 {vk_text}
@@ -383,48 +2985,227 @@ def improve_post_with_suggestions(vk_text, tg_text, suggestions, post_type, form
 {tg_text}
 """
 
-        user_prompt_improved = user_prompt + "\n\n" + improvement_instructions
-
-        response = deepseek_client.post(
-            "/v1/chat/completions",
-            json={
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt_improved}
-                ],
-                "response_format": {"type": "json_object"}
-            }
+    user_prompt_improved = user_prompt + "\n\n" + improvement_instructions
+
+    return request_json_completion([
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt_improved}
+    ], GENERATION_SCHEMA, 'improvement_prompt', kind='improvement')
+
+
+# --- СТРАНИЦЫ ПРИЛОЖЕНИЯ ---
+
+def paginate(df, key_prefix):
+    """Постраничный вывод: виджеты выбора страницы и срез df для текущей страницы"""
+    total = len(df)
+
+    col_size, col_page, col_info = st.columns([1, 1, 2])
+
+    with col_size:
+        page_size = st.selectbox(
+            "Постов на странице:",
+            PAGE_SIZE_OPTIONS,
+            index=PAGE_SIZE_OPTIONS.index(DEFAULT_PAGE_SIZE),
+            key=f"{key_prefix}_page_size"
         )
-        response.raise_for_status()
 
-        improved_json = response.json()['choices'][0]['message']['content']
-        return json.loads(improved_json)
+    pages = max(1, -(-total // page_size))
+    page_key = f"{key_prefix}_page"
+    # Номер страницы задаётся только через session_state (без value=), иначе Streamlit
+    # предупреждает о двух источниках значения. После смены фильтров страниц может стать
+    # меньше — не выходим за последнюю
+    if page_key not in st.session_state:
+        st.session_state[page_key] = 1
+    elif st.session_state[page_key] > pages:
+        st.session_state[page_key] = pages
 
-    except Exception as e:
-        st.error(f"❌ Ошибка улучшения поста: {e}")
+    with col_page:
+        page_number = st.number_input("Страница:", min_value=1, max_value=pages, key=page_key)
+
+    start = (page_number - 1) * page_size
+    end = min(start + page_size, total)
+
+    with col_info:
+        st.write("")
+        st.caption(f"Показаны {start + 1}–{end} из {total} · страница {page_number} из {pages}")
+
+    return df.iloc[start:end]
+
+
+def current_job():
+    """Активная фоновая задача сессии.
+
+    После переподключения браузера новая сессия подхватывает задачу по ?job= в адресе
+    и восстанавливает данные формы из контекста задачи.
+    """
+    job_id = st.session_state.get('active_job_id') or st.query_params.get('job')
+    if not job_id:
         return None
 
+    job = jobs.get(job_id)
+    if job is None:
+        # Задача истекла или процесс перезапускался
+        st.session_state.pop('active_job_id', None)
+        st.query_params.pop('job', None)
+        return None
+
+    if 'active_job_id' not in st.session_state:
+        st.session_state.form_data = job.context.get('form_data', {})
+        if job.context.get('generated_data') is not None:
+            st.session_state.generated_data = job.context['generated_data']
+    st.session_state.active_job_id = job_id
+    return job
+
+
+def start_job(kind, label, fn):
+    """Отправка задачи в очередь: в сессии остаётся только её ID"""
+    context = {
+        'form_data': st.session_state.get('form_data', {}),
+        'generated_data': st.session_state.get('generated_data'),
+    }
+    job = jobs.submit(kind, label, context, fn)
+    st.session_state.active_job_id = job.id
+    st.query_params['job'] = job.id
+    st.rerun()
+
+
+def finish_job(job):
+    """Перенос результата завершённой задачи в состояние сессии"""
+    st.session_state.pop('active_job_id', None)
+    st.query_params.pop('job', None)
+
+    if job.status == 'failed':
+        st.session_state.job_message = ('error', f"❌ {job.label}: {job.error}")
+        return
+
+    form_data = job.context.get('form_data', {})
+    if job.kind == 'generate':
+        st.session_state.generated_data = apply_custom_image(job.result, form_data)
+        st.session_state.analysis_result = None
+        st.session_state.job_message = ('success', "✅ Контент сгенерирован! Проверьте и сохраните ниже.")
+
+    elif job.kind == 'candidates':
+        ready = job.result
+        if not ready:
+            st.session_state.job_message = ('error', "❌ Не удалось сгенерировать ни одного варианта")
+            return
+        st.session_state.candidates = ready
+        st.session_state.candidate_index = 0
+        st.session_state.pop('candidate_choice', None)
+        st.session_state.generated_data = ready[0]['content']
+        st.session_state.analysis_result = ready[0].get('analysis')
+
+    elif job.kind == 'analyze':
+        st.session_state.analysis_result = job.result
+
+    elif job.kind == 'batch':
+        if not job.result:
+            st.session_state.job_message = ('error', "❌ Не удалось сгенерировать ни одного поста пакета")
+            return
+        st.session_state.batch_results = job.result
+        st.session_state.job_message = ('success', f"✅ Сгенерировано постов: {len(job.result)}. Проверьте и сохраните ниже.")
+
+    elif job.kind == 'improve':
+        # Сохраняем кастомные настройки изображения
+        st.session_state.generated_data = apply_custom_image(job.result, form_data)
+        st.session_state.analysis_result = None  # Очищаем анализ
+        st.session_state.candidates = []  # Улучшенный пост заменяет варианты
+        st.session_state.candidate_index = 0
+        st.session_state.job_message = ('success', "✅ Пост улучшен!")
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def job_progress_panel(job_id):
+    """Статус фоновой задачи: опрашивается сам, не перезапуская страницу, пока задача не завершится"""
+    job = jobs.get(job_id)
+    if job is None:
+        return
+
+    if job.done:
+        finish_job(job)
+        st.rerun()
+
+    st.info(f"⏳ {job.label}... {time.time() - job.created_at:.0f} с. Можно переключаться между страницами — результат не потеряется.")
+
+    preview = job.progress.get('preview')
+    if preview:
+        st.subheader("✍️ DeepSeek пишет...")
+        col_vk, col_tg = st.columns(2)
+        with col_vk:
+            st.markdown("**📱 VK**")
+            st.markdown(preview.get('vk_post') or "…")
+        with col_tg:
+            st.markdown("**✈️ Telegram**")
+            st.markdown(preview.get('tg_post') or "…")
+        st.markdown("**🎨 Промпт для изображения**")
+        st.caption(preview.get('image_prompt') or "…")
+
+    if job.progress.get('total'):
+        st.progress(job.progress['done'] / job.progress['total'])
+
+    for status in job.progress.get('statuses', []):
+        st.write(status)
+
+
+def show_job_message():
+    """Сообщение о завершении последней задачи (один раз после перезапуска страницы)"""
+    message = st.session_state.pop('job_message', None)
+    if message:
+        level, text = message
+        (st.success if level == 'success' else st.error)(text)
+
+
+def notify(text, icon="✅", balloons=False):
+    """Уведомление для показа после st.rerun(): вместо паузы, чтобы пользователь успел прочитать st.success"""
+    st.session_state.setdefault('toasts', []).append((text, icon))
+    if balloons:
+        st.session_state.toast_balloons = True
+
+
+def show_toasts():
+    """Показ накопленных уведомлений (один раз в начале прогона)"""
+    for text, icon in st.session_state.pop('toasts', []):
+        st.toast(text, icon=icon)
+    if st.session_state.pop('toast_balloons', False):
+        st.balloons()
+
+
+def wake_publisher():
+    """Пересборка очереди публикатора сразу после записи в Content_Plan, а не по таймеру"""
+    if app.publisher is not None:
+        app.publisher.wake()
+
+
+@contextlib.contextmanager
+def timed_write(action):
+    """Замер записи со страницы для страницы состояния (неудачные записи не учитываются)"""
+    started = time.perf_counter()
+    yield
+    app.record_write(action, time.perf_counter() - started)
 
-# --- СТРАНИЦЫ ПРИЛОЖЕНИЯ ---
 
 def page_create_post():
     """Страница создания поста"""
     st.title("🎨 Создать пост")
 
     # Загружаем промпты
-    prompts_df = load_prompts(client)
+    prompts = load_prompt_registry(client)
 
     # Инициализация session state
     if 'generated_data' not in st.session_state:
         st.session_state.generated_data = None
     if 'form_data' not in st.session_state:
         st.session_state.form_data = {}
-    if 'regeneration_count' not in st.session_state:
-        st.session_state.regeneration_count = 0
+    if 'candidates' not in st.session_state:
+        st.session_state.candidates = []
+        st.session_state.candidate_index = 0
     if 'analysis_result' not in st.session_state:
         st.session_state.analysis_result = None
 
+    # Пока идёт фоновая задача, кнопки запуска новых недоступны
+    job = current_job()
+    job_running = job is not None
+
     st.header("1️⃣ Настройка генерации")
 
     post_type = st.radio(
@@ -506,7 +3287,13 @@ def page_create_post():
                 help="Будет использован вместо автоматически сгенерированного"
             )
 
-        submit_button = st.form_submit_button("✨ Сгенерировать контент", width='stretch')
+        stream_output = st.checkbox(
+            "⚡ Показывать текст по мере генерации",
+            value=True,
+            help="Тексты появляются в предпросмотре сразу, не дожидаясь полного ответа DeepSeek"
+        )
+
+        submit_button = st.form_submit_button("✨ Сгенерировать контент", width='stretch', disabled=job_running)
 
     # Обработка генерации
     if submit_button:
@@ -522,93 +3309,87 @@ def page_create_post():
             "age": selected_age,
             "promo_code": promo_code,
             "custom_image_url": custom_image_url,
-            "custom_image_prompt": custom_image_prompt
+            "custom_image_prompt": custom_image_prompt,
+            "stream": stream_output
         }
-        st.session_state.regeneration_count = 0
-
-        with st.spinner("🎨 DeepSeek пишет тексты..."):
-            system_prompt, user_prompt = build_prompt(
-                post_type, selected_age, promo_code, service_info, discount_info, theme, prompts_df
-            )
+        st.session_state.candidates = []
+        st.session_state.candidate_index = 0
 
-            if system_prompt and user_prompt:
-                content_data = generate_text_content(system_prompt, user_prompt)
+        system_prompt, user_prompt = build_prompt(
+            post_type, selected_age, promo_code, service_info, discount_info, theme, prompts
+        )
 
-                if content_data:
-                    # Применяем кастомные настройки изображения
-                    if custom_image_url:
-                        content_data['image_prompt'] = f"[URL картинки: {custom_image_url}]"
-                    elif custom_image_prompt:
-                        content_data['image_prompt'] = custom_image_prompt
+        if system_prompt and user_prompt:
+            start_job(
+                'generate', "Генерация поста",
+                lambda job: job_generate_post(job, system_prompt, user_prompt, post_prompt_id(post_type), stream_output)
+            )
 
-                    st.session_state.generated_data = content_data
-                    st.success("✅ Контент сгенерирован! Проверьте и сохраните ниже.")
+    # Фоновая задача и её результат
+    if job_running:
+        job_progress_panel(job.id)
+    show_job_message()
 
-    # Блок предпросмотра и регенерации
+    # Блок предпросмотра и подбора лучшего варианта
     if st.session_state.generated_data:
-        st.header("3️⃣ Проверка и Регенерация")
-
-        # Счетчик попыток
-        col_counter, col_button = st.columns([1, 2])
-        with col_counter:
-            st.metric("Попыток регенерации", f"{st.session_state.regeneration_count}/{MAX_REGENERATIONS}")
+        st.header("3️⃣ Проверка и подбор лучшего варианта")
+        st.caption("DeepSeek параллельно напишет несколько вариантов, оценит каждый и покажет лучший первым")
+
+        col_count, col_button = st.columns([1, 2])
+        with col_count:
+            candidates_count = st.number_input(
+                "Вариантов:",
+                min_value=2,
+                max_value=PIPELINE_MAX_CANDIDATES,
+                value=PIPELINE_DEFAULT_CANDIDATES,
+                key="candidates_count"
+            )
 
         with col_button:
-            can_regenerate = st.session_state.regeneration_count < MAX_REGENERATIONS
-
-            if st.button("🔄 Регенерировать текст", disabled=not can_regenerate, width='stretch'):
-                st.session_state.regeneration_count += 1
+            st.write("")
+            if st.button("🏆 Сгенерировать варианты и выбрать лучший", width='stretch', disabled=job_running):
                 form_data = st.session_state.form_data
+                system_prompt, user_prompt = build_prompt_from_form(form_data, prompts)
 
-                with st.spinner("🎨 Регенерирую тексты..."):
-                    service_info_dict = form_data.get('service_info')
-                    service_info_obj = pd.Series(service_info_dict) if service_info_dict else None
-                    discount_info_dict = form_data.get('discount_info')
-                    discount_info_obj = pd.Series(discount_info_dict) if discount_info_dict else None
-
-                    system_prompt, user_prompt = build_prompt(
-                        form_data['Post_Type'],
-                        form_data['age'],
-                        form_data['promo_code'],
-                        service_info_obj,
-                        discount_info_obj,
-                        form_data['theme'],
-                        prompts_df
+                if system_prompt and user_prompt:
+                    start_job(
+                        'candidates', "Подбор лучшего варианта",
+                        lambda job: job_generate_candidates(
+                            job, system_prompt, user_prompt, form_data['Post_Type'], prompts, candidates_count, form_data
+                        )
                     )
-                    new_content = generate_text_content(system_prompt, user_prompt)
-
-                    if new_content:
-                        # Сохраняем кастомные настройки изображения
-                        if form_data.get('custom_image_url'):
-                            new_content['image_prompt'] = f"[URL картинки: {form_data['custom_image_url']}]"
-                        elif form_data.get('custom_image_prompt'):
-                            new_content['image_prompt'] = form_data['custom_image_prompt']
 
-                        st.session_state.generated_data = new_content
-                        st.success("✅ Тексты обновлены!")
-                        st.rerun()
-
-        if not can_regenerate:
-            st.warning(
-                f"⚠️ Достигнут лимит попыток регенерации ({MAX_REGENERATIONS}). Создайте новый пост для новых попыток.")
+        # Выбор между вариантами (лучший — первый)
+        candidates = st.session_state.candidates
+        if candidates:
+            choice = st.radio(
+                "Варианты (по убыванию оценки):",
+                list(range(len(candidates))),
+                index=st.session_state.candidate_index,
+                format_func=lambda i: (
+                    f"{'🏆 ' if i == 0 else ''}Вариант {i + 1}: "
+                    f"{(candidates[i].get('analysis') or {}).get('overall_score', '—')}/10"
+                ),
+                horizontal=True,
+                key="candidate_choice"
+            )
+            if choice != st.session_state.candidate_index:
+                st.session_state.candidate_index = choice
+                st.session_state.generated_data = candidates[choice]['content']
+                st.session_state.analysis_result = candidates[choice].get('analysis')
+                st.rerun()
 
         # НОВОЕ: Блок AI-советов
         st.divider()
         st.subheader("💡 AI-советы по улучшению")
 
-        if st.button("🔍 Проанализировать пост", width='stretch'):
-            with st.spinner("🤖 AI анализирует пост..."):
-                data = st.session_state.generated_data
-                analysis = analyze_post(
-                    data.get('vk_post', ''),
-                    data.get('tg_post', ''),
-                    st.session_state.form_data.get('Post_Type', ''),
-                    prompts_df
-                )
-
-                if analysis:
-                    st.session_state.analysis_result = analysis
-                    st.rerun()
+        if st.button("🔍 Проанализировать пост", width='stretch', disabled=job_running):
+            data = st.session_state.generated_data
+            post_type = st.session_state.form_data.get('Post_Type', '')
+            start_job(
+                'analyze', "Анализ поста",
+                lambda job: analyze_post(data.get('vk_post', ''), data.get('tg_post', ''), post_type, prompts)
+            )
 
         # Показываем результаты анализа если они есть
         if st.session_state.analysis_result:
@@ -661,7 +3442,7 @@ def page_create_post():
 
             # Кнопка применить улучшения - ПОСЛЕ рекомендаций
             st.divider()
-            if st.button("✨ Применить улучшения", width='stretch', type="primary"):
+            if st.button("✨ Применить улучшения", width='stretch', type="primary", disabled=job_running):
                 # Парсим отредактированные рекомендации
                 edited_suggestions_list = [
                     line.strip().lstrip('- ').strip()
@@ -672,30 +3453,18 @@ def page_create_post():
                 if not edited_suggestions_list:
                     st.warning("⚠️ Добавьте хотя бы одну рекомендацию для улучшения")
                 else:
-                    with st.spinner("🎨 Улучшаю пост с учётом рекомендаций..."):
-                        data = st.session_state.generated_data
-                        improved_content = improve_post_with_suggestions(
-                            data.get('vk_post', ''),
-                            data.get('tg_post', ''),
-                            edited_suggestions_list,
-                            st.session_state.form_data.get('Post_Type', ''),
-                            st.session_state.form_data,
-                            prompts_df
+                    data = st.session_state.generated_data
+                    system_prompt, user_prompt = build_prompt_from_form(st.session_state.form_data, prompts)
+
+                    if system_prompt and user_prompt:
+                        start_job(
+                            'improve', "Улучшение поста",
+                            lambda job: improve_post_with_suggestions(
+                                data.get('vk_post', ''), data.get('tg_post', ''), edited_suggestions_list,
+                                system_prompt, user_prompt, prompts
+                            )
                         )
 
-                        if improved_content:
-                            # Сохраняем кастомные настройки изображения
-                            form_data = st.session_state.form_data
-                            if form_data.get('custom_image_url'):
-                                improved_content['image_prompt'] = f"[URL картинки: {form_data['custom_image_url']}]"
-                            elif form_data.get('custom_image_prompt'):
-                                improved_content['image_prompt'] = form_data['custom_image_prompt']
-
-                            st.session_state.generated_data = improved_content
-                            st.session_state.analysis_result = None  # Очищаем анализ
-                            st.success("✅ Пост улучшен!")
-                            st.rerun()
-
         st.divider()
 
         # Блок предпросмотра и планирования
@@ -748,22 +3517,10 @@ def page_create_post():
         if save_button:
             try:
                 with st.spinner("💾 Сохраняю в Google Sheets..."):
-                    spreadsheet = client.open_by_key(SHEET_ID)
-                    content_plan_sheet = spreadsheet.worksheet("Content_Plan")
                     form_data = st.session_state.form_data
 
                     # Генерация уникального ID
-                    existing_ids = content_plan_sheet.col_values(1)[1:]
-                    max_num = 0
-                    for id_str in existing_ids:
-                        if id_str.startswith('POST_'):
-                            try:
-                                num = int(id_str.split('_')[1])
-                                max_num = max(max_num, num)
-                            except:
-                                pass
-
-                    new_id = f"POST_{max_num + 1}"
+                    new_id = allocate_post_ids()[0]
 
                     publish_datetime = f"{publish_date} {publish_time}"
 
@@ -778,24 +3535,178 @@ def page_create_post():
                         datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     ]
 
-                    content_plan_sheet.append_row(row_to_add, value_input_option='USER_ENTERED')
-                    load_content_plan.clear()
+                    with timed_write("Сохранение поста"):
+                        replica.append_rows("Content_Plan", [row_to_add], value_input_option='USER_ENTERED')
+                    wake_publisher()
 
-                    st.success(f"🎉 Пост {new_id} успешно запланирован на {publish_datetime}!")
-                    st.balloons()
+                    notify(f"Пост {new_id} успешно запланирован на {publish_datetime}!", icon="🎉", balloons=True)
 
                     st.session_state.generated_data = None
                     st.session_state.form_data = {}
-                    st.session_state.regeneration_count = 0
+                    st.session_state.candidates = []
+                    st.session_state.candidate_index = 0
                     st.session_state.analysis_result = None
 
-                    time.sleep(2)
                     st.rerun()
 
             except Exception as e:
                 st.error(f"❌ Не удалось сохранить пост: {e}")
 
 
+def page_batch_generation():
+    """Страница пакетной генерации постов на период контент-плана"""
+    st.title("📦 Пакетная генерация")
+    st.caption("Сгенерируйте посты сразу на неделю или месяц: выберите услуги и темы, задайте период — "
+               "DeepSeek напишет все тексты параллельно, а сохранение займёт один запрос к Google Sheets.")
+
+    prompts = load_prompt_registry(client)
+
+    if 'batch_results' not in st.session_state:
+        st.session_state.batch_results = None
+
+    # Пакет генерируется фоновой задачей: клик по странице не прерывает оплаченные запросы
+    job = current_job()
+    job_running = job is not None
+
+    with st.form("batch_form"):
+        col1, col2 = st.columns(2)
+
+        with col1:
+            selected_services = st.multiselect(
+                "Рекламные посты по услугам:",
+                services_df['Name'].tolist() if not services_df.empty else []
+            )
+            themes_text = st.text_area(
+                "Познавательные посты (по одной теме в строке):",
+                placeholder="Мифы о гиалуроновой кислоте\nКак подготовить кожу к лету",
+                height=120
+            )
+            promo_code = st.text_input("Промокод для рекламных постов (если есть):", placeholder="BEAUTY20")
+
+        with col2:
+            date_from = st.date_input("Период с:", value=datetime.now().date() + timedelta(days=1))
+            date_to = st.date_input("по:", value=datetime.now().date() + timedelta(days=7))
+            batch_time = st.time_input("Время публикации:", value=datetime.strptime("12:00", "%H:%M").time())
+            batch_status = st.selectbox(
+                "Статус после сохранения:",
+                ["Draft", "Ready"],
+                help="Draft — посты попадут в план как черновики, чтобы вы проверили их перед публикацией"
+            )
+
+        start_button = st.form_submit_button("🚀 Сгенерировать пакет", width='stretch', disabled=job_running)
+
+    if start_button:
+        themes = [line.strip() for line in themes_text.split('\n') if line.strip()]
+        if not selected_services and not themes:
+            st.warning("⚠️ Выберите хотя бы одну услугу или введите тему")
+            return
+        if date_to < date_from:
+            st.warning("⚠️ Дата окончания периода раньше даты начала")
+            return
+
+        # Собираем промпты для всех постов пакета
+        items = []
+        for service_name in selected_services:
+            service_info = services_df[services_df['Name'] == service_name].iloc[0]
+            age = service_info.get('Default_Age', 'Все')
+            system_prompt, user_prompt = build_prompt(
+                "Рекламный", age, promo_code, service_info, None, None, prompts
+            )
+            items.append({"label": f"🎯 {service_name}", "Post_Type": "Рекламный",
+                          "system_prompt": system_prompt, "user_prompt": user_prompt})
+
+        for theme in themes:
+            system_prompt, user_prompt = build_prompt(
+                "Познавательный", "Все", promo_code, None, None, theme, prompts
+            )
+            items.append({"label": f"📚 {theme}", "Post_Type": "Познавательный",
+                          "system_prompt": system_prompt, "user_prompt": user_prompt})
+
+        if any(not item['system_prompt'] or not item['user_prompt'] for item in items):
+            return
+
+        # Равномерно раскладываем посты по дням периода
+        days = (date_to - date_from).days + 1
+        for index, item in enumerate(items):
+            publish_date = date_from + timedelta(days=index * days // len(items))
+            item['Publish_Time'] = f"{publish_date} {batch_time}"
+            item['Status'] = batch_status
+
+        st.session_state.batch_results = None
+        start_job(
+            'batch', f"Генерация пакета из {len(items)} постов",
+            lambda job: job_generate_batch(job, items)
+        )
+
+    if job_running:
+        job_progress_panel(job.id)
+    show_job_message()
+
+    results = st.session_state.batch_results
+    if not results:
+        return
+
+    st.divider()
+    st.header(f"📋 Готово постов: {len(results)}")
+    st.caption("Снимите галочку с постов, которые не нужно сохранять")
+
+    selected = []
+    for index, result in enumerate(results):
+        content = result['content']
+        col_check, col_preview = st.columns([1, 4])
+        with col_check:
+            if st.checkbox(result['Publish_Time'], value=True, key=f"batch_keep_{index}"):
+                selected.append(result)
+        with col_preview:
+            with st.expander(result['label']):
+                col_vk, col_tg = st.columns(2)
+                with col_vk:
+                    st.markdown("**VK:**")
+                    st.write(content.get('vk_post', ''))
+                with col_tg:
+                    st.markdown("**Telegram:**")
+                    st.write(content.get('tg_post', ''))
+
+    col_save, col_discard = st.columns(2)
+
+    with col_save:
+        if st.button(f"💾 Сохранить {len(selected)} постов в контент-план", width='stretch',
+                     type="primary", disabled=not selected):
+            try:
+                with st.spinner("💾 Сохраняю в Google Sheets..."):
+                    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    post_ids = allocate_post_ids(len(selected))
+                    rows = [
+                        [
+                            post_id,
+                            result['Publish_Time'],
+                            result['Status'],
+                            result['Post_Type'],
+                            result['content'].get('vk_post', ''),
+                            result['content'].get('tg_post', ''),
+                            result['content'].get('image_prompt', ''),
+                            created_at
+                        ]
+                        for post_id, result in zip(post_ids, selected)
+                    ]
+
+                    # Один запрос append_rows на весь пакет
+                    with timed_write("Сохранение пакета"):
+                        replica.append_rows("Content_Plan", rows, value_input_option='USER_ENTERED')
+                    wake_publisher()
+
+                notify(f"Сохранено постов: {len(rows)} ({post_ids[0]} … {post_ids[-1]})", icon="🎉")
+                st.session_state.batch_results = None
+                st.rerun()
+            except Exception as e:
+                st.error(f"❌ Не удалось сохранить посты: {e}")
+
+    with col_discard:
+        if st.button("🗑️ Отменить пакет", width='stretch'):
+            st.session_state.batch_results = None
+            st.rerun()
+
+
 def page_dashboard():
     """Страница Dashboard со статистикой"""
     st.title("📊 Dashboard")
@@ -806,23 +3717,25 @@ def page_dashboard():
         st.info("🔭 Контент-план пуст. Создайте первый пост!")
         return
 
-    # Статистика
+    # Статистика: один подсчёт по категориям на каждый столбец
+    status_counts = df['Status'].value_counts()
+    status_counts = status_counts[status_counts > 0]
+    type_counts = df['Post_Type'].value_counts()
+    type_counts = type_counts[type_counts > 0]
+
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
         st.metric("Всего постов", len(df))
 
     with col2:
-        ready_count = len(df[df['Status'] == 'Ready'])
-        st.metric("Запланировано", ready_count)
+        st.metric("Запланировано", int(status_counts.get('Ready', 0)))
 
     with col3:
-        published_count = len(df[df['Status'] == 'Published'])
-        st.metric("Опубликовано", published_count)
+        st.metric("Опубликовано", int(status_counts.get('Published', 0)))
 
     with col4:
-        promo_count = len(df[df['Post_Type'] == 'Рекламный'])
-        st.metric("Рекламных", promo_count)
+        st.metric("Рекламных", int(type_counts.get('Рекламный', 0)))
 
     st.divider()
 
@@ -831,7 +3744,8 @@ def page_dashboard():
 
     with col_chart1:
         st.subheader("📊 Типы постов")
-        type_counts = df['Post_Type'].value_counts()
+        import plotly.express as px  # plotly нужен только здесь — не грузим его на остальных страницах
+
         fig_pie = px.pie(
             values=type_counts.values,
             names=type_counts.index,
@@ -841,7 +3755,6 @@ def page_dashboard():
 
     with col_chart2:
         st.subheader("📈 Статусы постов")
-        status_counts = df['Status'].value_counts()
         fig_bar = px.bar(
             x=status_counts.index,
             y=status_counts.values,
@@ -857,23 +3770,15 @@ def page_dashboard():
     st.subheader("📅 Ближайшие публикации (7 дней)")
 
     try:
-        df['Publish_DateTime'] = pd.to_datetime(df['Publish_Time'], format='mixed', errors='coerce')
         # Отладка: выводим проблемные строки
-        invalid_dates = df[df['Publish_DateTime'].isna()]['Publish_Time']
+        invalid_dates = df[df.index.isna()]['Publish_Time']
         if not invalid_dates.empty:
             st.sidebar.warning(f"⚠️ Не удалось распарсить даты: {invalid_dates.tolist()}")
         today = datetime.now()
         week_later = today + timedelta(days=7)
 
-        # Убираем NaT (Not a Time) значения
-        df_valid = df.dropna(subset=['Publish_DateTime'])
-
-        upcoming = df_valid[
-            (df_valid['Publish_DateTime'] >= today) &
-            (df_valid['Publish_DateTime'] <= week_later) &
-            (df_valid['Status'] == 'Ready')
-            ].sort_values('Publish_DateTime')
-
+        upcoming = slice_by_publish_time(df, today, week_later)
+        upcoming = upcoming[upcoming['Status'] == 'Ready']
 
         if upcoming.empty:
             st.info("🔭 Нет запланированных публикаций на ближайшие 7 дней")
@@ -897,11 +3802,118 @@ def page_dashboard():
     except Exception as e:
         st.error(f"❌ Ошибка отображения ближайших публикаций: {e}")
 
+    st.divider()
+
+    # Кэш ответов DeepSeek
+    st.subheader("🧠 Кэш ответов DeepSeek")
+
+    cache_stats = llm_cache.stats()
+    cache_requests = cache_stats['hits'] + cache_stats['misses']
+    hit_rate = cache_stats['hits'] / cache_requests * 100 if cache_requests else 0
+
+    col_hits, col_rate, col_tokens, col_entries = st.columns(4)
+
+    with col_hits:
+        st.metric("Ответов из кэша", cache_stats['hits'])
+
+    with col_rate:
+        st.metric("Hit rate", f"{hit_rate:.0f}%")
+
+    with col_tokens:
+        st.metric("Сэкономлено токенов", f"{cache_stats['saved_tokens']:,}".replace(",", " "))
+
+    with col_entries:
+        st.metric("Записей в кэше", cache_stats['entries'])
+
+    parse_stats = output_stats.stats()
+    st.caption(
+        f"🩹 Разбор ответов: без правок — {parse_stats['clean']}, починено — {parse_stats['repaired']} "
+        f"({parse_stats['repair_rate']:.0f}%), запрошено заново — {parse_stats['failed']}"
+    )
+
+    st.divider()
+    show_llm_performance()
+
+
+def show_llm_performance():
+    """Раздел Dashboard «Производительность»: задержки, токены и стоимость вызовов DeepSeek"""
+    import plotly.express as px
+    st.subheader("⚡ Производительность")
+    st.caption(f"Вызовы DeepSeek за {LLM_METRICS_DASHBOARD_DAYS} дней (ответы из локального кэша не учитываются)")
+
+    calls = pd.DataFrame(llm_metrics.calls(time.time() - LLM_METRICS_DASHBOARD_DAYS * 24 * 3600))
+    if calls.empty:
+        st.info("🔭 Пока нет данных — они появятся после первой генерации")
+        return
+
+    calls['Дата'] = pd.to_datetime(calls['created_at'], unit='s').dt.date
+    generations = calls[calls['kind'] == 'generation']
+    prompt_tokens = calls['prompt_tokens'].sum()
+
+    col_calls, col_p50, col_p95, col_ttfb, col_cost, col_hit = st.columns(6)
+    with col_calls:
+        st.metric("Вызовов", len(calls))
+    with col_p50:
+        st.metric("Длительность, p50", f"{calls['latency'].quantile(0.5):.1f} с")
+    with col_p95:
+        st.metric("Длительность, p95", f"{calls['latency'].quantile(0.95):.1f} с")
+    with col_ttfb:
+        st.metric("До первого байта, p50", f"{calls['ttfb'].quantile(0.5):.1f} с")
+    with col_cost:
+        # Стоимость поста — все вызовы (варианты, анализ, улучшения, повторы) на один пост,
+        # начатый пользователем: kind 'generation' пишется один раз на пост (см. schema_kind)
+        cost_per_post = calls['cost'].sum() / len(generations) if len(generations) else 0.0
+        st.metric("Стоимость поста", f"${cost_per_post:.4f}")
+    with col_hit:
+        hit_share = calls['cache_hit_tokens'].sum() / prompt_tokens * 100 if prompt_tokens else 0
+        st.metric("Вход из кэша DeepSeek", f"{hit_share:.0f}%")
+
+    daily = calls.groupby('Дата').agg(
+        p50=('latency', lambda values: values.quantile(0.5)),
+        p95=('latency', lambda values: values.quantile(0.95)),
+        cost=('cost', 'sum')
+    )
+    daily['posts'] = generations.groupby('Дата').size()
+    daily['Стоимость поста, $'] = daily['cost'] / daily['posts']
+    daily = daily.reset_index()
+
+    col_latency, col_cost_chart = st.columns(2)
+    with col_latency:
+        st.markdown("**⏱️ Длительность вызова по дням, с**")
+        fig_latency = px.line(daily, x='Дата', y=['p50', 'p95'], markers=True)
+        fig_latency.update_layout(legend_title_text="", xaxis_title="", yaxis_title="")
+        st.plotly_chart(fig_latency, use_container_width=True, config={'displayModeBar': False})
+    with col_cost_chart:
+        st.markdown("**💵 Стоимость поста по дням, $**")
+        fig_cost = px.bar(daily, x='Дата', y='Стоимость поста, $', color_discrete_sequence=['#4ECDC4'])
+        fig_cost.update_layout(xaxis_title="", yaxis_title="")
+        st.plotly_chart(fig_cost, use_container_width=True, config={'displayModeBar': False})
+
+    st.markdown("**🧾 По шаблонам промптов**")
+    by_prompt = calls.groupby('prompt_id').agg(
+        calls=('cost', 'size'),
+        prompt_tokens=('prompt_tokens', 'mean'),
+        completion_tokens=('completion_tokens', 'mean'),
+        p50=('latency', lambda values: values.quantile(0.5)),
+        p95=('latency', lambda values: values.quantile(0.95)),
+        retries=('retries', 'sum'),
+        cost=('cost', 'sum')
+    ).sort_values('cost', ascending=False).reset_index()
+    st.dataframe(
+        by_prompt.rename(columns={
+            'prompt_id': "Prompt_ID", 'calls': "Вызовов", 'prompt_tokens': "Вход, ток. (сред.)",
+            'completion_tokens': "Выход, ток. (сред.)", 'p50': "p50, с", 'p95': "p95, с",
+            'retries': "Повторов", 'cost': "Всего, $"
+        }).round({"Вход, ток. (сред.)": 0, "Выход, ток. (сред.)": 0, "p50, с": 1, "p95, с": 1, "Всего, $": 4}),
+        width='stretch', hide_index=True
+    )
+
 
 def page_content_plan():
     """Страница контент-плана с редактированием и удалением"""
     st.title("📅 Контент-план")
 
+    replica.refresh_if_stale()
     df = load_content_plan(client)
 
     if df.empty:
@@ -933,7 +3945,7 @@ def page_content_plan():
         )
 
     # Применение фильтров
-    filtered_df = df.copy()
+    filtered_df = df
 
     if status_filter != "Все":
         filtered_df = filtered_df[filtered_df['Status'] == status_filter]
@@ -941,24 +3953,37 @@ def page_content_plan():
     if type_filter != "Все":
         filtered_df = filtered_df[filtered_df['Post_Type'] == type_filter]
 
-    # Сортировка
-    try:
-        filtered_df['Publish_DateTime'] = pd.to_datetime(filtered_df['Publish_Time'])
-        ascending = sort_order == "По дате (старые)"
-        filtered_df = filtered_df.sort_values('Publish_DateTime', ascending=ascending)
-    except:
-        pass
+    # Сортировка: кадр уже упорядочен по дате публикации
+    filtered_df = order_by_publish_time(filtered_df, ascending=sort_order == "По дате (старые)")
 
     st.divider()
 
+    # Выбор постов для массовых действий живёт в session_state и переживает смену страницы и фильтров:
+    # {ID: версия строки в момент выбора}, чтобы не перезаписать пост, изменённый после этого
+    selected = st.session_state.setdefault('plan_selected', {})
+    for post_id in set(selected) - set(df['ID'].astype(str)):
+        del selected[post_id]
+    bulk_actions_panel(df, filtered_df, selected)
+
     # Отображение постов
     if filtered_df.empty:
         st.info("🔍 Посты не найдены по заданным фильтрам")
         return
 
-    for list_idx, (idx, row) in enumerate(filtered_df.iterrows()):
+    page_df = paginate(filtered_df, "plan")
+    st.divider()
+
+    # Ключи виджетов строятся от ID (он уникален), а не от позиции в списке или номера строки,
+    # поэтому не меняются при смене страницы, фильтра, сортировки и удалении постов выше
+    for _, row in page_df.iterrows():
         with st.container():
-            col_info, col_actions = st.columns([4, 1])
+            col_select, col_info, col_actions = st.columns([0.3, 4, 1])
+
+            with col_select:
+                select_key = f"plan_select_{row['ID']}"
+                st.session_state[select_key] = str(row['ID']) in selected
+                st.checkbox("Выбрать", key=select_key, label_visibility="collapsed",
+                            on_change=toggle_plan_selection, args=(str(row['ID']), select_key))
 
             with col_info:
                 post_type_emoji = "🎯" if row['Post_Type'] == 'Рекламный' else "📚"
@@ -967,7 +3992,8 @@ def page_content_plan():
                 st.markdown(f"### {status_emoji} {post_type_emoji} {row['Post_Type']} | {row['Publish_Time']}")
                 st.caption(f"ID: {row['ID']}")
 
-                with st.expander("📱 Посмотреть тексты"):
+                # Тексты выводятся только для раскрытых постов
+                if st.toggle("📱 Посмотреть тексты", key=f"plan_texts_{row['ID']}"):
                     col_vk, col_tg = st.columns(2)
                     with col_vk:
                         st.markdown("**VK:**")
@@ -981,12 +4007,14 @@ def page_content_plan():
                         st.info(row['Image_Prompt'])
 
             with col_actions:
-                if st.button("✏️ Редактировать", key=f"edit_{row['ID']}_{list_idx}"):
+                if st.button("✏️ Редактировать", key=f"edit_{row['ID']}"):
                     st.session_state.editing_post = row.to_dict()
+                    st.session_state.editing_post_version = replica.row_version("Content_Plan", row['ID'])
                     st.rerun()
 
-                if st.button("🗑️ Удалить", key=f"delete_{row['ID']}_{list_idx}"):
+                if st.button("🗑️ Удалить", key=f"delete_{row['ID']}"):
                     st.session_state.deleting_post = row['ID']
+                    st.session_state.deleting_post_version = replica.row_version("Content_Plan", row['ID'])
                     st.rerun()
 
             st.divider()
@@ -1000,6 +4028,111 @@ def page_content_plan():
         delete_post_dialog(st.session_state.deleting_post)
 
 
+def toggle_plan_selection(post_id, select_key):
+    """Колбэк чекбокса поста: переносит его состояние в выбранные вместе с версией строки"""
+    if st.session_state[select_key]:
+        st.session_state.plan_selected[post_id] = replica.row_version("Content_Plan", post_id)
+    else:
+        st.session_state.plan_selected.pop(post_id, None)
+
+
+def set_plan_selection(post_ids):
+    """Колбэк кнопок «Выбрать все» / «Снять выбор»: выбранные посты с версиями их строк"""
+    st.session_state.plan_selected = {post_id: replica.row_version("Content_Plan", post_id) for post_id in post_ids}
+
+
+def bulk_actions_panel(df, filtered_df, selected):
+    """Массовые действия над выбранными постами: сдвиг даты, смена статуса, удаление.
+
+    Каждое действие — один запрос к таблице: изменения строк уходят одним batch_update
+    через WriteCoalescer, удаление — одним batch_update с deleteDimension.
+    """
+    col_count, col_all, col_none = st.columns([2, 1, 1])
+    with col_count:
+        st.markdown(f"**☑️ Выбрано постов: {len(selected)}**")
+    with col_all:
+        st.button(f"Выбрать все по фильтру ({len(filtered_df)})", width='stretch', key="plan_select_all",
+                  on_click=set_plan_selection, args=(filtered_df['ID'].astype(str).tolist(),))
+    with col_none:
+        st.button("Снять выбор", width='stretch', key="plan_select_none", disabled=not selected,
+                  on_click=set_plan_selection, args=([],))
+
+    if not selected:
+        return
+
+    chosen = df[df['ID'].astype(str).isin(list(selected))]
+
+    col_shift, col_status, col_delete = st.columns(3)
+
+    with col_shift:
+        days = st.number_input("Сдвинуть на дней:", min_value=-365, max_value=365, value=7, step=1, key="plan_shift_days")
+        if st.button("📆 Перенести", width='stretch', key="plan_shift", disabled=days == 0):
+            dated = chosen[chosen['Publish_DateTime'].notna()]
+            updates = {
+                str(post_id): {'Publish_Time': (publish_time + timedelta(days=int(days))).strftime("%Y-%m-%d %H:%M")}
+                for post_id, publish_time in zip(dated['ID'], dated['Publish_DateTime'])
+            }
+            apply_bulk_update(updates, selected, f"📆 Перенесено на {int(days)} дн.", skipped=len(chosen) - len(dated))
+
+    with col_status:
+        new_status = st.selectbox("Новый статус:", ["Ready", "Published", "Draft"], key="plan_bulk_status")
+        if st.button("🏷️ Сменить статус", width='stretch', key="plan_bulk_status_apply"):
+            updates = {str(post_id): {'Status': new_status} for post_id in chosen['ID']}
+            apply_bulk_update(updates, selected, f"🏷️ Статус {new_status} установлен")
+
+    with col_delete:
+        st.write("")
+        st.write("")
+        if st.button(f"🗑️ Удалить выбранные ({len(chosen)})", width='stretch', key="plan_bulk_delete"):
+            st.session_state.bulk_deleting = True
+
+    if st.session_state.get('bulk_deleting'):
+        st.warning(f"⚠️ Удалить {len(chosen)} постов? Это действие нельзя отменить.")
+        col_confirm, col_cancel = st.columns(2)
+        with col_confirm:
+            if st.button("🗑️ Да, удалить", key="plan_bulk_delete_confirm"):
+                del st.session_state.bulk_deleting
+                try:
+                    with timed_write("Массовое удаление"):
+                        errors = replica.delete_rows_by_key(
+                            "Content_Plan", chosen['ID'].astype(str).tolist(), expected_versions=selected
+                        )
+                    finish_bulk_action("🗑️ Удалено", len(chosen) - len(errors), errors)
+                except Exception as e:
+                    st.error(f"❌ Ошибка удаления: {e}")
+        with col_cancel:
+            if st.button("❌ Отмена", key="plan_bulk_delete_cancel"):
+                del st.session_state.bulk_deleting
+                st.rerun()
+
+    st.divider()
+
+
+def apply_bulk_update(updates, selected, label, skipped=0):
+    """Запись изменений полей выбранных постов одним запросом (с проверкой версий из selected)"""
+    try:
+        with timed_write("Массовое изменение"):
+            errors = replica.update_fields_by_key("Content_Plan", updates, expected_versions=selected)
+    except Exception as e:
+        st.error(f"❌ Ошибка сохранения: {e}")
+        return
+    done = len(updates) - len(errors)
+    if skipped:
+        errors[f"{skipped} без даты"] = "дата публикации не распознана"
+    finish_bulk_action(label, done, errors)
+
+
+def finish_bulk_action(label, done, errors):
+    """Итог массового действия показывается после перезапуска страницы"""
+    message = f"{label}: {done} постов"
+    if errors:
+        message += " · пропущены: " + "; ".join(f"{key} ({error})" for key, error in errors.items())
+    notify(message, icon="⚠️" if errors else "✅")
+    wake_publisher()
+    st.session_state.plan_selected = {}
+    st.rerun()
+
+
 def edit_post_dialog(post_data):
     """Диалог редактирования поста"""
     st.subheader(f"✏️ Редактирование поста {post_data['ID']}")
@@ -1026,12 +4159,6 @@ def edit_post_dialog(post_data):
 
     if save_button:
         try:
-            spreadsheet = client.open_by_key(SHEET_ID)
-            worksheet = spreadsheet.worksheet("Content_Plan")
-
-            all_ids = worksheet.col_values(1)
-            row_index = all_ids.index(post_data['ID']) + 1
-
             current_created_at = post_data.get('Created_At', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
             updated_row = [
@@ -1045,14 +4172,25 @@ def edit_post_dialog(post_data):
                 current_created_at
             ]
 
-            worksheet.update(f'A{row_index}:H{row_index}', [updated_row])
-            load_content_plan.clear()
+            with timed_write("Редактирование поста"):
+                replica.update_row_by_key(
+                    "Content_Plan", post_data['ID'], updated_row,
+                    expected_version=st.session_state.get('editing_post_version')
+                )
+            wake_publisher()
+            # Своя правка не должна выглядеть чужой для массовых действий над выбранным постом
+            selected = st.session_state.get('plan_selected', {})
+            if str(post_data['ID']) in selected:
+                selected[str(post_data['ID'])] = replica.row_version("Content_Plan", post_data['ID'])
 
-            st.success("✅ Пост обновлен!")
+            notify("Пост обновлен!")
             del st.session_state.editing_post
-            time.sleep(1)
             st.rerun()
 
+        except RowConflictError as e:
+            st.warning(f"⚠️ Изменения не сохранены: пост {e}. Откройте его заново, чтобы увидеть актуальную версию.")
+            del st.session_state.editing_post
+
         except Exception as e:
             st.error(f"❌ Ошибка обновления: {e}")
 
@@ -1070,19 +4208,21 @@ def delete_post_dialog(post_id):
     with col_confirm:
         if st.button("🗑️ Да, удалить", key="confirm_delete"):
             try:
-                spreadsheet = client.open_by_key(SHEET_ID)
-                worksheet = spreadsheet.worksheet("Content_Plan")
-
-                all_ids = worksheet.col_values(1)
-                row_index = all_ids.index(post_id) + 1
-                worksheet.delete_rows(row_index)
-                load_content_plan.clear()
+                with timed_write("Удаление поста"):
+                    replica.delete_row_by_key(
+                        "Content_Plan", post_id,
+                        expected_version=st.session_state.get('deleting_post_version')
+                    )
+                wake_publisher()
 
-                st.success("✅ Пост удален!")
+                notify("Пост удален!")
                 del st.session_state.deleting_post
-                time.sleep(1)
                 st.rerun()
 
+            except RowConflictError as e:
+                st.warning(f"⚠️ Пост не удалён: {e}. Проверьте контент-план ещё раз.")
+                del st.session_state.deleting_post
+
             except Exception as e:
                 st.error(f"❌ Ошибка удаления: {e}")
 
@@ -1096,7 +4236,7 @@ def page_archive():
     """Страница архива/истории постов"""
     st.title("📜 Архив постов")
 
-    load_content_plan.clear()  # Очищаем кэш
+    replica.refresh_if_stale()
     df = load_content_plan(client)
 
     if df.empty:
@@ -1108,11 +4248,11 @@ def page_archive():
     col_f1, col_f2, col_f3, col_f4 = st.columns(4)
 
     with col_f1:
-        try:
-            df['Publish_DateTime'] = pd.to_datetime(df['Publish_Time'], errors='coerce')
-            min_date = df['Publish_DateTime'].min().date()
-            max_date = df['Publish_DateTime'].max().date()
-        except:
+        dated = df.index.dropna()
+        if len(dated):
+            min_date = dated[0].date()
+            max_date = dated[-1].date()
+        else:
             min_date = datetime.now().date() - timedelta(days=30)
             max_date = datetime.now().date()
 
@@ -1135,17 +4275,8 @@ def page_archive():
             key="archive_status_filter"
         )
 
-    # Применение фильтров
-    filtered_df = df.copy()
-
-    try:
-        filtered_df['Publish_DateTime'] = pd.to_datetime(filtered_df['Publish_Time'], format='mixed', errors='coerce')
-        filtered_df = filtered_df[
-            (filtered_df['Publish_DateTime'].dt.date >= date_from) &
-            (filtered_df['Publish_DateTime'].dt.date <= date_to)
-            ]
-    except:
-        pass
+    # Применение фильтров: период — срез по индексу дат
+    filtered_df = slice_by_publish_time(df, date_from, date_to + timedelta(days=1))
 
     if type_filter != "Все":
         filtered_df = filtered_df[filtered_df['Post_Type'] == type_filter]
@@ -1186,17 +4317,24 @@ def page_archive():
     st.subheader(f"📋 Найдено постов: {len(filtered_df)}")
 
     # Сортировка по дате (новые первые)
-    try:
-        filtered_df = filtered_df.sort_values('Publish_DateTime', ascending=False)
-    except:
-        pass
+    filtered_df = order_by_publish_time(filtered_df, ascending=False)
 
-    # Отображение постов
-    for list_idx, (idx, row) in enumerate(filtered_df.iterrows()):
-        with st.expander(
-                f"{row.get('Publish_Time', 'Нет даты')} | {row['Post_Type']} | {row['Status']}",
-                expanded=False
-        ):
+    page_df = paginate(filtered_df, "archive")
+
+    # Отображение постов: тексты выводятся только для раскрытых постов
+    for _, row in page_df.iterrows():
+        col_title, col_toggle = st.columns([5, 1])
+
+        with col_title:
+            st.markdown(f"**{row.get('Publish_Time', 'Нет даты')} | {row['Post_Type']} | {row['Status']}**")
+
+        with col_toggle:
+            is_open = st.toggle("Открыть", key=f"archive_open_{row['ID']}")
+
+        if not is_open:
+            continue
+
+        with st.container(border=True):
             col_info, col_preview = st.columns([1, 2])
 
             with col_info:
@@ -1212,7 +4350,7 @@ def page_archive():
                     value=row['VK_Text'],
                     height=150,
                     disabled=True,
-                    key=f"archive_vk_{row['ID']}_{list_idx}",
+                    key=f"archive_vk_{row['ID']}",
                     label_visibility="collapsed"
                 )
 
@@ -1222,7 +4360,7 @@ def page_archive():
                     value=row['TG_Text'],
                     height=150,
                     disabled=True,
-                    key=f"archive_tg_{row['ID']}_{list_idx}",
+                    key=f"archive_tg_{row['ID']}",
                     label_visibility="collapsed"
                 )
 
@@ -1235,7 +4373,7 @@ def page_settings():
     """Страница настроек: редактор промптов + General Info"""
     st.title("⚙️ Настройки")
 
-    tab1, tab2 = st.tabs(["📝 Промпты", "🎯 Общие настройки"])
+    tab1, tab2, tab3 = st.tabs(["📝 Промпты", "🎯 Общие настройки", "🗂️ Структура таблицы"])
 
     # Вкладка 1: Редактор промптов
     with tab1:
@@ -1291,6 +4429,16 @@ def page_settings():
 
         st.markdown(f"**ID:** `{selected_prompt_id}`")
 
+        selected_template = load_prompt_registry(client).get(selected_prompt_id) or PromptTemplate(
+            str(selected_prompt_row['Prompt_Text']), selected_prompt_id
+        )
+        if selected_template.unknown:
+            st.warning(
+                "⚠️ Неизвестные переменные: "
+                + ", ".join(f"`{{{name}}}`" for name in selected_template.unknown)
+                + ". Они останутся в тексте промпта как есть."
+            )
+
         with st.form("edit_prompt_form"):
             new_prompt_text = st.text_area(
                 "Текст промпта:",
@@ -1310,20 +4458,16 @@ def page_settings():
 
         if save_prompt_button:
             try:
-                spreadsheet = client.open_by_key(SHEET_ID)
-                worksheet = spreadsheet.worksheet("Prompts")
-
                 # Находим строку по Prompt_ID
-                all_ids = worksheet.col_values(1)
-                row_index = all_ids.index(selected_prompt_id) + 1
+                row_index = replica.find_row("Prompts", selected_prompt_id)
+                if row_index is None:
+                    raise ValueError(f"промпт {selected_prompt_id} не найден")
 
                 # Обновляем только Prompt_Text (колонка C)
-                worksheet.update(f'C{row_index}', [[new_prompt_text]])
+                with timed_write("Сохранение промпта"):
+                    replica.update_cells("Prompts", row_index, 3, [new_prompt_text])
 
-                load_prompts.clear()
-
-                st.success(f"✅ Промпт '{selected_prompt_name}' успешно обновлен!")
-                time.sleep(1)
+                notify(f"Промпт '{selected_prompt_name}' успешно обновлен!")
                 st.rerun()
 
             except Exception as e:
@@ -1332,40 +4476,45 @@ def page_settings():
         if reset_button:
             st.info("ℹ️ Функция сброса к исходному промпту будет доступна в следующей версии")
 
+        with st.expander("⏱️ Скорость подстановки переменных"):
+            st.caption("Сравнение прежней подстановки через str.replace и разобранного шаблона на выбранном промпте")
+            if st.button("▶️ Запустить замер", key="prompt_benchmark"):
+                sample = {name: f"<{name}>" for name in ALL_PROMPT_VARIABLES}
+                result = benchmark_prompt_rendering(selected_template, sample)
+                col_legacy, col_compiled, col_speedup = st.columns(3)
+                with col_legacy:
+                    st.metric("str.replace, мкс", f"{result['legacy']:.1f}")
+                with col_compiled:
+                    st.metric("Шаблон, мкс", f"{result['compiled']:.1f}")
+                with col_speedup:
+                    st.metric("Ускорение", f"×{result['legacy'] / max(result['compiled'], 1e-9):.1f}")
+                if not result['same_output']:
+                    st.warning("⚠️ Результаты различаются: значения переменных сами содержат плейсхолдеры")
+
     # Вкладка 2: Общие настройки
     with tab2:
         st.subheader("Общие настройки салона")
         st.caption("Эти параметры используются при генерации контента")
 
-        try:
-            spreadsheet = client.open_by_key(SHEET_ID)
-            general_info_sheet = spreadsheet.worksheet("General_Info")
-            general_info_data = general_info_sheet.get_all_records()
-
-            # Преобразуем в словарь для удобства
-            current_settings = {row['Key']: row['Value'] for row in general_info_data}
-
-        except Exception as e:
-            st.error(f"❌ Ошибка загрузки настроек: {e}")
-            return
+        settings_store = SettingsStore(replica)
 
         with st.form("general_settings_form"):
             tone_of_voice = st.text_area(
                 "Tone of Voice (стиль общения):",
-                value=current_settings.get('Tone_of_Voice', 'Профессионально и дружелюбно'),
+                value=settings_store.get('Tone_of_Voice'),
                 height=100,
                 help="Определяет стиль и тон общения в постах"
             )
 
             address = st.text_input(
                 "Адрес салона:",
-                value=current_settings.get('Address', 'Москва'),
+                value=settings_store.get('Address'),
                 help="Будет использоваться в постах при необходимости"
             )
 
             blacklist_words = st.text_area(
                 "Запрещенные слова (через запятую):",
-                value=current_settings.get('Blacklist_Words', ''),
+                value=settings_store.get('Blacklist_Words'),
                 height=100,
                 help="Слова, которые AI должен избегать в текстах"
             )
@@ -1374,28 +4523,20 @@ def page_settings():
 
         if save_settings_button:
             try:
-                # Обновляем каждую настройку
-                settings_to_update = {
+                form_settings = {
                     'Tone_of_Voice': tone_of_voice,
                     'Address': address,
                     'Blacklist_Words': blacklist_words
                 }
 
-                all_keys = general_info_sheet.col_values(1)
-
-                for key, value in settings_to_update.items():
-                    if key in all_keys:
-                        row_index = all_keys.index(key) + 1
-                        general_info_sheet.update(f'B{row_index}', [[value]])
-                    else:
-                        # Если ключа нет, добавляем новую строку
-                        general_info_sheet.append_row([key, value])
-
-                load_data_from_sheets.clear()
+                if not settings_store.diff(form_settings):
+                    st.info("ℹ️ Изменений нет — сохранять нечего")
+                else:
+                    with timed_write("Сохранение настроек"):
+                        changes = settings_store.save(form_settings)
 
-                st.success("✅ Настройки успешно сохранены!")
-                time.sleep(1)
-                st.rerun()
+                    notify(f"Настройки успешно сохранены! Изменено: {', '.join(changes)}")
+                    st.rerun()
 
             except Exception as e:
                 st.error(f"❌ Ошибка сохранения настроек: {e}")
@@ -1424,16 +4565,211 @@ def page_settings():
 
         st.info("💡 Для редактирования услуг и акций используйте Google Sheets напрямую")
 
+    # Вкладка 3: Проверка структуры таблицы
+    with tab3:
+        st.subheader("Структура Google Таблицы")
+        st.caption("Проверяется один раз при запуске приложения. После ручных изменений листов запустите проверку заново.")
+
+        if schema is None:
+            st.error("❌ Структуру таблицы проверить не удалось")
+        else:
+            col_fp, col_checked = st.columns(2)
+            with col_fp:
+                st.metric("Отпечаток схемы", schema['fingerprint'])
+            with col_checked:
+                st.metric("Проверено", schema['checked_at'])
+
+            schema_rows = [
+                {
+                    "Лист": name,
+                    "Статус": ("✅" if not info['missing_columns'] else "⚠️") if info['exists'] else "❌ нет листа",
+                    "Не хватает столбцов": ", ".join(info['missing_columns']) if info['exists'] else "",
+                }
+                for name, info in schema['sheets'].items()
+            ]
+            st.dataframe(pd.DataFrame(schema_rows), width='stretch', hide_index=True)
+
+            if schema['created']:
+                st.info(f"📋 Созданы автоматически: {', '.join(schema['created'])}")
+
+        if st.button("🔄 Перепроверить схему", width='stretch'):
+            previous_fingerprint = schema['fingerprint'] if schema else None
+            try:
+                new_schema = app.revalidate_schema()
+                if new_schema is None:
+                    raise RuntimeError(app.schema_error)
+                replica.request_sync()
+                if new_schema['fingerprint'] == previous_fingerprint:
+                    st.success("✅ Структура таблицы не изменилась")
+                else:
+                    st.success("✅ Структура таблицы обновлена")
+                    st.rerun()
+            except Exception as e:
+                st.error(f"❌ Ошибка при проверке структуры таблицы: {e}")
+
+
+def percentile(values, q):
+    """Перцентиль q (0–100) без numpy: ближайшее значение по рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def page_health():
+    """Страница состояния: холодный старт, накладные расходы прогонов, синхронизация, DeepSeek"""
+    st.title("🩺 Состояние")
+
+    problems = []
+    if app.schema_error:
+        problems.append(f"Структура таблицы: {app.schema_error}")
+    if replica.last_sync_error:
+        problems.append(f"Синхронизация: {replica.last_sync_error}")
+
+    if problems:
+        st.error("❌ degraded\n\n" + "\n\n".join(problems))
+    else:
+        st.success("✅ ok")
+
+    # Холодный старт
+    st.subheader("🚀 Холодный старт")
+    st.caption(f"Контекст приложения создан {app.created_at}")
+    timings = [{"Шаг": label, "мс": round(seconds * 1000, 1)} for label, seconds in app.bootstrap_timings.items()]
+    timings.append({"Шаг": "Итого", "мс": round(sum(app.bootstrap_timings.values()) * 1000, 1)})
+    st.dataframe(pd.DataFrame(timings), width='stretch', hide_index=True)
+
+    # Прогоны скрипта
+    st.subheader("⏱️ Прогоны скрипта")
+    runs = app.runs()
+    if not runs:
+        st.info("ℹ️ Завершённых прогонов пока нет")
+    else:
+        bootstrap = [run['bootstrap'] * 1000 for run in runs]
+        total = [run['total'] * 1000 for run in runs]
+
+        col_count, col_overhead, col_p50, col_p95 = st.columns(4)
+        with col_count:
+            st.metric("Прогонов", len(runs))
+        with col_overhead:
+            st.metric("До меню, p50", f"{percentile(bootstrap, 50):.1f} мс")
+        with col_p50:
+            st.metric("Прогон целиком, p50", f"{percentile(total, 50):.0f} мс")
+        with col_p95:
+            st.metric("Прогон целиком, p95", f"{percentile(total, 95):.0f} мс")
+
+        by_page = {}
+        for run in runs:
+            by_page.setdefault(run['page'], []).append(run['total'] * 1000)
+        st.dataframe(pd.DataFrame([
+            {"Страница": name, "Прогонов": len(values),
+             "p50, мс": round(percentile(values, 50)), "p95, мс": round(percentile(values, 95))}
+            for name, values in by_page.items()
+        ]), width='stretch', hide_index=True)
+
+    # Записи со страниц
+    st.subheader("✍️ Записи в таблицу")
+    writes = app.writes()
+    if not writes:
+        st.info("ℹ️ Записей со страниц пока не было")
+    else:
+        st.caption("От нажатия кнопки до перезапуска страницы. Раньше сюда добавлялась пауза 1–2 с перед st.rerun()")
+        by_action = {}
+        for write in writes:
+            by_action.setdefault(write['action'], []).append(write['seconds'] * 1000)
+        st.dataframe(pd.DataFrame([
+            {"Действие": name, "Записей": len(values),
+             "p50, мс": round(percentile(values, 50)), "p95, мс": round(percentile(values, 95))}
+            for name, values in by_action.items()
+        ]), width='stretch', hide_index=True)
+
+    # Синхронизация
+    st.subheader("🔄 Синхронизация таблицы")
+    now = time.time()
+    col_sync, col_probe = st.columns(2)
+    with col_sync:
+        st.metric("Последняя синхронизация", f"{now - replica.last_sync_at:.0f} с назад" if replica.last_sync_at else "—")
+    with col_probe:
+        st.metric("Последняя проверка маркеров", f"{now - replica.last_probe_at:.0f} с назад" if replica.last_probe_at else "—")
+    st.dataframe(pd.DataFrame([
+        {"Лист": name, "Версия в реплике": replica.version(name)} for name in REPLICA_SHEETS
+    ]), width='stretch', hide_index=True)
+    write_stats = replica.coalescer.stats
+    st.caption(
+        f"✍️ Правки строк: {write_stats['rows']} строк отправлено за {write_stats['requests']} запросов, "
+        f"пакетов с построчным повтором — {write_stats['fallbacks']}"
+    )
+
+    # DeepSeek
+    st.subheader("🧠 DeepSeek")
+    cache_stats = llm_cache.stats()
+    col_http, col_hits, col_entries = st.columns(3)
+    with col_http:
+        st.metric("HTTP/2", "да" if HTTP2_AVAILABLE else "нет")
+    with col_hits:
+        st.metric("Ответов из кэша", cache_stats['hits'])
+    with col_entries:
+        st.metric("Записей в кэше", cache_stats['entries'])
+
+    breaker_labels = {'closed': "✅ замкнута", 'open': "⛔ разомкнута", 'half_open': "🔄 пробный запрос"}
+    col_breaker, col_tokens, col_retries, col_limited = st.columns(4)
+    with col_breaker:
+        st.metric("Цепь DeepSeek", breaker_labels[llm.breaker.state])
+    with col_tokens:
+        st.metric("Свободно запросов", f"{llm.bucket.tokens:.1f} / {LLM_RATE_BURST}")
+    with col_retries:
+        st.metric("Повторов", llm.stats['retries'])
+    with col_limited:
+        st.metric("Ответов 429", llm.stats['rate_limited'])
+
+    parse_stats = output_stats.stats()
+    col_clean, col_repaired, col_failed = st.columns(3)
+    with col_clean:
+        st.metric("JSON без правок", parse_stats['clean'])
+    with col_repaired:
+        st.metric("JSON починен", parse_stats['repaired'], f"{parse_stats['repair_rate']:.0f}%", delta_color="off")
+    with col_failed:
+        st.metric("Не удалось починить", parse_stats['failed'])
+
+    # Публикатор
+    st.subheader("📤 Публикатор")
+    publisher = app.publisher
+    if publisher is None:
+        st.caption("Выключен (PUBLISHER_ENABLED в secrets.toml) — публикацией занимается n8n")
+        return
+    next_due = publisher.next_due
+    col_networks, col_next, col_published, col_failed = st.columns(4)
+    with col_networks:
+        st.metric("Сети", ", ".join(network.upper() for network in publisher.networks) or "—")
+    with col_next:
+        st.metric("Следующий пост", datetime.fromtimestamp(next_due).strftime("%d.%m %H:%M") if next_due else "—")
+    with col_published:
+        st.metric("Опубликовано", publisher.stats['published'])
+    with col_failed:
+        st.metric("Ошибок публикации", publisher.stats['failed'])
+    if publisher.last_error:
+        st.warning(f"⚠️ Последняя ошибка: {publisher.last_error}")
+
 
 # --- ГЛАВНОЕ МЕНЮ НАВИГАЦИИ ---
 
+ROUTER_STARTED = time.perf_counter()
+
+if st.query_params.get("page") == HEALTH_QUERY_PAGE:
+    # Отдельная страница без меню — для проверки состояния по ссылке
+    try:
+        page_health()
+    finally:
+        app.record_run(HEALTH_QUERY_PAGE, ROUTER_STARTED - SCRIPT_STARTED, time.perf_counter() - SCRIPT_STARTED)
+    st.stop()
+
 st.sidebar.title("🤖 AI-Контент Студия")
 st.sidebar.markdown("### Салон красоты Шарм")
 st.sidebar.divider()
 
 page = st.sidebar.radio(
     "Навигация:",
-    ["🎨 Создать пост", "📊 Dashboard", "📅 Контент-план", "📜 Архив", "⚙️ Настройки"],
+    ["🎨 Создать пост", "📦 Пакетная генерация", "📊 Dashboard", "📅 Контент-план", "📜 Архив", "⚙️ Настройки",
+     "🩺 Состояние"],
     label_visibility="collapsed"
 )
 
@@ -1457,14 +4793,24 @@ st.sidebar.markdown(
     unsafe_allow_html=True
 )
 
+show_toasts()
+
 # Роутинг страниц
-if page == "🎨 Создать пост":
-    page_create_post()
-elif page == "📊 Dashboard":
-    page_dashboard()
-elif page == "📅 Контент-план":
-    page_content_plan()
-elif page == "📜 Архив":
-    page_archive()
-elif page == "⚙️ Настройки":
-    page_settings()
\ No newline at end of file
+try:
+    if page == "🎨 Создать пост":
+        page_create_post()
+    elif page == "📦 Пакетная генерация":
+        page_batch_generation()
+    elif page == "📊 Dashboard":
+        page_dashboard()
+    elif page == "📅 Контент-план":
+        page_content_plan()
+    elif page == "📜 Архив":
+        page_archive()
+    elif page == "⚙️ Настройки":
+        page_settings()
+    elif page == "🩺 Состояние":
+        page_health()
+finally:
+    # st.rerun() и st.stop() завершают прогон исключением — после записи обычно именно так
+    app.record_run(page, ROUTER_STARTED - SCRIPT_STARTED, time.perf_counter() - SCRIPT_STARTED)
\ No newline at end of file